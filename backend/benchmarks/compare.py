@@ -0,0 +1,57 @@
+"""Compares two benchmark results, route by route.
+
+    python -m benchmarks.compare before.json after.json [--fail-above 10]
+
+Exits with 1 if --fail-above is given and the p95 latency of any route got worse by more than that many percent.
+"""
+import argparse
+import json
+import sys
+
+METRICS = ("throughput", "p50_ms", "p95_ms", "p99_ms")
+
+
+def change(before: float, after: float) -> float | None:
+    return (after - before) / before * 100 if before else None
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--fail-above", type=float, help="percent p95 regression that fails the comparison")
+    args = parser.parse_args(argv)
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    regressions = []
+    for mix, after_mix in after["mixes"].items():
+        before_mix = before["mixes"].get(mix)
+        if not before_mix:
+            print(f"{mix}: not in {args.before}")
+            continue
+        print(f"{mix}: {before_mix['throughput']} -> {after_mix['throughput']} req/s")
+        for route, after_route in after_mix["routes"].items():
+            before_route = before_mix["routes"].get(route)
+            if not before_route:
+                continue
+            columns = []
+            for metric in METRICS:
+                delta = change(before_route[metric], after_route[metric])
+                columns.append(f"{metric} {before_route[metric]} -> {after_route[metric]}"
+                               + (f" ({delta:+.1f}%)" if delta is not None else ""))
+            print(f"  {route}: " + ", ".join(columns))
+            delta = change(before_route["p95_ms"], after_route["p95_ms"])
+            if args.fail_above is not None and delta is not None and delta > args.fail_above:
+                regressions.append(f"{mix} {route}: p95 {delta:+.1f}%")
+
+    if regressions:
+        print("\nRegressions:\n  " + "\n  ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+"""In-process stand-ins for the services the backend talks to, so it can be benchmarked without them.
+
+Every fake can add a fixed latency per call to model the round trip to the real service.
+"""
+import asyncio
+import sys
+from datetime import datetime, timezone
+from typing import Any
+from uuid import uuid4
+
+from prisma import models
+
+# model accessor -> (model class name, primary key)
+MODELS = {
+    "users": ("Users", "id"),
+    "oauthstates": ("OAuthStates", "state"),
+    "oauthcodes": ("OAuthCodes", "code"),
+    "refreshtokens": ("RefreshTokens", "token"),
+    "stages": ("Stages", "id"),
+    "invites": ("Invites", "id"),
+    "chatmessages": ("ChatMessages", "id"),
+}
+# model accessor -> relation -> (related accessor, local field, related field, is a list)
+RELATIONS = {
+    "oauthcodes": {"user": ("users", "user_id", "id", False)},
+    "refreshtokens": {"user": ("users", "user_id", "id", False)},
+    "stages": {"owner": ("users", "owner_id", "id", False), "invites": ("invites", "id", "stage_id", True)},
+    "invites": {"stage": ("stages", "stage_id", "id", False), "user": ("users", "user_id", "id", False)},
+    "chatmessages": {"user": ("users", "user_id", "id", False), "stage": ("stages", "stage_id", "id", False)},
+}
+# values the database fills in for fields that are left out
+DEFAULTS = {
+    "oauthstates": {"next": "/"},
+    "stages": {"password": None, "private": False, "color": "#00A9A5"},
+    "chatmessages": {"type": "TEXT", "message_data": ""},
+}
+
+
+def _compare(value: Any, op: str, expected: Any) -> bool:
+    if op == "equals":
+        return value == expected
+    if op == "not":
+        return value != expected
+    if op == "in":
+        return value in expected
+    if op == "not_in":
+        return value not in expected
+    if op == "startsWith":
+        return isinstance(value, str) and value.startswith(expected)
+    if op == "endsWith":
+        return isinstance(value, str) and value.endswith(expected)
+    if op == "contains":
+        return isinstance(value, str) and expected in value
+    if value is None or expected is None:
+        return False
+    if op == "lt":
+        return value < expected
+    if op == "lte":
+        return value <= expected
+    if op == "gt":
+        return value > expected
+    if op == "gte":
+        return value >= expected
+    raise NotImplementedError(f"Filter {op} is not supported by the fake database")
+
+
+class FakeModelActions:
+    def __init__(self, db: "FakePrisma", name: str):
+        self._db = db
+        self._name = name
+        self._model = getattr(models, MODELS[name][0])
+        self._key = MODELS[name][1]
+        self.rows: dict[str, dict] = {}
+
+    def _matches(self, row: dict, where: dict | None) -> bool:
+        for field, condition in (where or {}).items():
+            if field == "AND":
+                if not all(self._matches(row, w) for w in condition):
+                    return False
+            elif field == "OR":
+                if not any(self._matches(row, w) for w in condition):
+                    return False
+            elif field == "NOT":
+                if self._matches(row, condition):
+                    return False
+            elif field in RELATIONS.get(self._name, {}):
+                related, local, remote, _ = RELATIONS[self._name][field]
+                actions = self._db.actions[related]
+                candidates = [r for r in actions.rows.values() if r[remote] == row[local]]
+                for op, sub in condition.items():
+                    if op in ("some", "is") and not any(actions._matches(r, sub) for r in candidates):
+                        return False
+                    if op == "every" and not all(actions._matches(r, sub) for r in candidates):
+                        return False
+                    if op in ("none", "is_not") and any(actions._matches(r, sub) for r in candidates):
+                        return False
+            elif isinstance(condition, dict):
+                if not all(_compare(row.get(field), op, expected) for op, expected in condition.items()):
+                    return False
+            elif row.get(field) != condition:
+                return False
+        return True
+
+    def _build(self, row: dict, include: dict | None):
+        data = dict(row)
+        for relation, enabled in (include or {}).items():
+            if not enabled:
+                continue
+            related, local, remote, many = RELATIONS[self._name][relation]
+            actions = self._db.actions[related]
+            matches = [actions._build(r, None) for r in actions.rows.values() if r[remote] == row[local]]
+            data[relation] = matches if many else (matches[0] if matches else None)
+        return self._model(**data)
+
+    def _select(self, where: dict | None, order: list[dict] | dict | None = None, cursor: dict | None = None,
+                skip: int | None = None, take: int | None = None) -> list[dict]:
+        rows = [row for row in self.rows.values() if self._matches(row, where)]
+        if isinstance(order, dict):
+            order = [order]
+        for entry in reversed(order or []):
+            ((field, direction),) = entry.items()
+            rows.sort(key=lambda r: (r[field] is not None, r[field]), reverse=direction == "desc")
+        if cursor:
+            ((field, value),) = cursor.items()
+            rows = rows[next((i for i, r in enumerate(rows) if r[field] == value), len(rows)):]
+        rows = rows[skip or 0:]
+        return rows[:take] if take is not None else rows
+
+    def _insert(self, data: dict) -> dict:
+        now = datetime.now(timezone.utc)
+        row = {**DEFAULTS.get(self._name, {}), "created_at": now, "updated_at": now}
+        for field, value in data.items():
+            if field in RELATIONS.get(self._name, {}) and isinstance(value, dict) and "connect" in value:
+                related, local, remote, _ = RELATIONS[self._name][field]
+                row[local] = value["connect"][remote]
+            else:
+                row[field] = value
+        row.setdefault(self._key, uuid4().hex)
+        if row[self._key] in self.rows:
+            raise ValueError(f"Unique constraint failed on {self._name}.{self._key}")
+        self.rows[row[self._key]] = row
+        return row
+
+    async def find_unique(self, where: dict, include: dict | None = None):
+        await self._db.round_trip()
+        rows = self._select(where, take=1)
+        return self._build(rows[0], include) if rows else None
+
+    async def find_first(self, where: dict | None = None, include: dict | None = None, order=None, cursor=None,
+                         skip: int | None = None):
+        await self._db.round_trip()
+        rows = self._select(where, order, cursor, skip, 1)
+        return self._build(rows[0], include) if rows else None
+
+    async def find_many(self, where: dict | None = None, include: dict | None = None, order=None, cursor=None,
+                        skip: int | None = None, take: int | None = None):
+        await self._db.round_trip()
+        return [self._build(row, include) for row in self._select(where, order, cursor, skip, take)]
+
+    async def count(self, where: dict | None = None, **_) -> int:
+        await self._db.round_trip()
+        return len(self._select(where))
+
+    async def create(self, data: dict, include: dict | None = None):
+        await self._db.round_trip()
+        return self._build(self._insert(data), include)
+
+    async def create_many(self, data: list[dict], skip_duplicates=False) -> int:
+        await self._db.round_trip()
+        created = 0
+        for item in data:
+            if skip_duplicates and item.get(self._key) in self.rows:
+                continue
+            self._insert(item)
+            created += 1
+        return created
+
+    async def update(self, data: dict, where: dict, include: dict | None = None):
+        await self._db.round_trip()
+        rows = self._select(where, take=1)
+        if not rows:
+            return None
+        rows[0].update(data, updated_at=datetime.now(timezone.utc))
+        return self._build(rows[0], include)
+
+    async def delete(self, where: dict, include: dict | None = None):
+        await self._db.round_trip()
+        rows = self._select(where, take=1)
+        if not rows:
+            return None
+        model = self._build(rows[0], include)
+        del self.rows[rows[0][self._key]]
+        return model
+
+    async def delete_many(self, where: dict | None = None) -> int:
+        await self._db.round_trip()
+        rows = self._select(where)
+        for row in rows:
+            del self.rows[row[self._key]]
+        return len(rows)
+
+
+class FakePrisma:
+    """An in-memory replacement for the Prisma client, covering the queries the backend makes"""
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.queries = 0
+        self._connected = False
+        self.actions = {name: FakeModelActions(self, name) for name in MODELS}
+        for name, actions in self.actions.items():
+            setattr(self, name, actions)
+
+    async def round_trip(self):
+        self.queries += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        else:
+            await asyncio.sleep(0)
+
+    async def connect(self):
+        self._connected = True
+
+    async def disconnect(self):
+        self._connected = False
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+
+class FakeRoomServiceClient:
+    """Accepts LiveKit API calls and only counts them"""
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.calls: dict[str, int] = {}
+
+    async def _call(self, method: str):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        await asyncio.sleep(self.latency)
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def send_data(self, room: str, data: bytes, kind: int, destination_sids: list[str]):
+        await self._call("SendData")
+        return {}
+
+    async def update_participant(self, room: str, identity: str, metadata: str | None = None, permission=None):
+        await self._call("UpdateParticipant")
+        return {}
+
+
+class FakeB2:
+    """Takes uploads like util/b2.py does and throws them away"""
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.uploaded = 0
+
+    async def upload_file(self, file: bytes, filename: str, content_type: str) -> str:
+        await asyncio.sleep(self.latency)
+        self.uploaded += len(file)
+        return f"https://b2.invalid/file/bench/{filename}"
+
+    async def upload_stream(self, pipe, length: int, filename: str, content_type: str) -> str:
+        def drain():
+            stream = pipe.open_once()
+            received = 0
+            while chunk := stream.read(64 * 1024):
+                received += len(chunk)
+            return received
+
+        self.uploaded += await asyncio.get_running_loop().run_in_executor(None, drain)
+        await asyncio.sleep(self.latency)
+        return f"https://b2.invalid/file/bench/{filename}"
+
+
+def fake_github(latency: float = 0):
+    """A GitHub provider that accepts any code, and logs in a user named after it"""
+    from concert_backend.util.auth.providers import GitHub
+
+    class FakeGitHub(GitHub):
+        @classmethod
+        async def get_token(cls, code: str):
+            await asyncio.sleep(latency)
+            return {"access_token": code, "refresh_token": None}
+
+        @classmethod
+        async def get_user_info(cls, access_token: str, refresh_token: str | None):
+            await asyncio.sleep(latency)
+            return {
+                "provider_id": access_token,
+                "username": f"bench-{access_token}",
+                "email": f"{access_token}@bench.invalid",
+                "avatar_url": "https://b2.invalid/avatar.png",
+                "provider": "github"
+            }
+
+        @classmethod
+        async def revoke_token(cls, access_token: str, refresh_token: str | None):
+            return True
+
+    return FakeGitHub
+
+
+def replace_everywhere(original: Any, replacement: Any, prefix="concert_backend") -> int:
+    """Points every module-level name bound to `original` in the backend's modules to `replacement`.
+
+    The backend imports its clients by name (`from ...db import db`), so patching only the defining module
+    would leave the copies in the routers untouched.
+    """
+    replaced = 0
+    for name, module in list(sys.modules.items()):
+        if module is None or not (name == prefix or name.startswith(prefix + ".")):
+            continue
+        for attr, value in list(vars(module).items()):
+            if value is original:
+                setattr(module, attr, replacement)
+                replaced += 1
+    return replaced
+
+
+def install(db_latency: float = 0, livekit_latency: float = 0, b2_latency: float = 0, github_latency: float = 0,
+            fake_db=True) -> dict[str, Any]:
+    """Swaps the backend's external clients for fakes. Must run after `concert_backend` is imported."""
+    from concert_backend.util import b2
+    from concert_backend.util.auth import providers
+    from concert_backend.util.db import db
+    from concert_backend.util.livekit.client import client
+
+    fakes: dict[str, Any] = {
+        "livekit": FakeRoomServiceClient(livekit_latency),
+        "b2": FakeB2(b2_latency),
+        "github": fake_github(github_latency),
+    }
+    replace_everywhere(client, fakes["livekit"])
+    replace_everywhere(b2.upload_file, fakes["b2"].upload_file)
+    replace_everywhere(b2.upload_stream, fakes["b2"].upload_stream)
+    providers.providers["github"] = fakes["github"]
+    if fake_db:
+        # the queries still go through the instrumented wrapper, like they would in production
+        fakes["db"] = db.client = FakePrisma(db_latency)
+    return fakes
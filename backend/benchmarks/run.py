@@ -0,0 +1,362 @@
+"""Replays traffic mixes against the backend and reports throughput and latency percentiles per route.
+
+The app runs in its own process with LiveKit, B2 and GitHub replaced by fakes, and MongoDB by an in-memory fake
+unless --database-url points to a local database (which gets test data written to it and removed afterwards).
+
+    python -m benchmarks.run --mix join_storm,chat_burst --users 500 --output before.json
+    python -m benchmarks.compare before.json after.json
+
+Results are printed as JSON, so runs can be compared.
+"""
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import platform
+import sys
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from urllib.parse import urlparse, parse_qs
+
+import httpx
+
+MIXES = ("join_storm", "chat_burst", "listing_browse", "login")
+# settings that change the results, recorded with them
+TUNABLES = ("WORKERS", "DB_POOL_SIZE", "KV_URL", "REFRESH_TOKEN_MODE")
+TUNABLE_PREFIXES = ("CHAT_", "RESPONSE_CACHE_", "ACCESS_INDEX_", "USER_CACHE_", "LIVEKIT_TOKEN_", "PASSWORD_")
+BENCH_ENV = {
+    "JWT_SECRET": "benchmark",
+    "LIVEKIT_URL": "http://livekit.invalid",
+    "LIVEKIT_KEY": "benchmark",
+    "LIVEKIT_SECRET": "benchmark-livekit-secret",
+    "FRONTEND_URL": "http://localhost:3000",
+    "GITHUB_CLIENT_ID": "benchmark",
+    "GITHUB_CLIENT_SECRET": "benchmark",
+    "REAPER_INTERVAL": "0",
+}
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """Nearest-rank percentile of sorted `values`"""
+    if not values:
+        return 0
+    return values[min(len(values) - 1, max(0, math.ceil(pct / 100 * len(values)) - 1))]
+
+
+# Server process
+
+async def seed(db, users: int, stages: int, messages: int, run_id: str) -> dict:
+    from concert_backend.util.auth.tokens import generate_access_token_for
+
+    created_users = [await db.users.create({
+        "email": f"{run_id}-{i}@bench.invalid",
+        "username": f"bench-{i}",
+        "avatar_url": "https://b2.invalid/avatar.png",
+        "provider": "github",
+        "provider_id": f"{run_id}-{i}",
+    }) for i in range(users)]
+    concert = await db.stages.create({"name": "Concert", "private": False, "owner_id": created_users[0].id})
+    stage_ids = [concert.id]
+    for i in range(stages):
+        owner = created_users[i % len(created_users)]
+        stage = await db.stages.create({"name": f"Stage {i}", "private": i % 5 == 0, "owner_id": owner.id})
+        stage_ids.append(stage.id)
+        if stage.private:
+            await db.invites.create({"stage_id": stage.id, "user_id": created_users[(i + 1) % len(created_users)].id})
+    await db.chatmessages.create_many([{
+        "type": "TEXT",
+        "message_data": f"message {i}",
+        "stage_id": concert.id,
+        "user_id": created_users[i % len(created_users)].id,
+    } for i in range(messages)])
+    return {
+        "users": [{"id": user.id, "token": generate_access_token_for(user.id)} for user in created_users],
+        "concert": concert.id,
+        "stages": stage_ids,
+    }
+
+
+async def cleanup(db, seeded: dict, run_id: str):
+    from concert_backend.util.chat_writer import chat_writer
+
+    await chat_writer.flush()
+    # the seeded users, and the ones created by the login mix
+    users = await db.users.find_many(where={"provider_id": {"startsWith": run_id}})
+    user_ids = [user.id for user in users]
+    await db.chatmessages.delete_many(where={"stage_id": {"in": seeded["stages"]}})
+    await db.invites.delete_many(where={"stage_id": {"in": seeded["stages"]}})
+    await db.stages.delete_many(where={"id": {"in": seeded["stages"]}})
+    await db.refreshtokens.delete_many(where={"user_id": {"in": user_ids}})
+    await db.users.delete_many(where={"id": {"in": user_ids}})
+
+
+async def serve(options: dict, conn):
+    from concert_backend import app
+    from benchmarks.fakes import install
+
+    fakes = install(options["db_latency"], options["livekit_latency"], options["b2_latency"],
+                    options["github_latency"], fake_db=not options["database_url"])
+    from concert_backend.util.db import db  # noqa, the fake if one was installed
+
+    server = await app.create_server(host="127.0.0.1", port=options["port"], return_asyncio_server=True,
+                                     access_log=False)
+    await server.startup()
+    await server.before_start()
+    seeded = await seed(db, options["users"], options["stages"], options["messages"], options["run_id"])
+    await server.after_start()
+    conn.send(seeded)
+
+    serving = asyncio.ensure_future(server.serve_forever())
+    await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+    stats = {
+        "db_queries": getattr(db, "queries", None),
+        "livekit_calls": fakes["livekit"].calls,
+        "b2_bytes": fakes["b2"].uploaded,
+    }
+    if options["database_url"]:
+        await cleanup(db, seeded, options["run_id"])
+    await server.before_stop()
+    serving.cancel()
+    await server.close()
+    await server.after_stop()
+    conn.send(stats)
+
+
+def run_server(options: dict, conn):
+    for key, value in BENCH_ENV.items():
+        os.environ.setdefault(key, value)
+    os.environ["SELF_URL"] = f"http://127.0.0.1:{options['port']}"
+    if options["database_url"]:
+        os.environ["DATABASE_URL"] = options["database_url"]
+    asyncio.run(serve(options, conn))
+
+
+# Load generator
+
+@dataclass
+class Sample:
+    route: str
+    status: int
+    latency: float
+
+
+@dataclass
+class Bench:
+    http: httpx.AsyncClient
+    seeded: dict
+    samples: list[Sample] = field(default_factory=list)
+
+    async def request(self, route: str, method: str, url: str, token: str | None = None, **kwargs) -> httpx.Response:
+        """Sends a request, timing it under the route template `route`"""
+        headers = kwargs.pop("headers", {})
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        start = time.perf_counter()
+        try:
+            res = await self.http.request(method, url, headers=headers, **kwargs)
+        except httpx.HTTPError:
+            self.samples.append(Sample(route, 0, time.perf_counter() - start))
+            raise
+        self.samples.append(Sample(route, res.status_code, time.perf_counter() - start))
+        return res
+
+    async def join(self, user: dict, sid: str, route_prefix="") -> str | None:
+        res = await self.request(f"{route_prefix}GET /api/stage/<sid>/token", "GET", f"/api/stage/{sid}/token",
+                                 user["token"])
+        return res.json().get("token") if res.status_code == 200 else None
+
+
+async def join_storm(bench: Bench, user: dict, i: int, options: dict):
+    """Everyone opens the concert at once: stage info, a LiveKit token and the recent chat"""
+    sid = bench.seeded["concert"]
+    await bench.request("GET /api/stages/<sid>", "GET", f"/api/stages/{sid}", user["token"])
+    livekit_token = await bench.join(user, sid)
+    if livekit_token:
+        await bench.request("GET /api/stage/<sid>/chat", "GET", f"/api/stage/{sid}/chat", user["token"],
+                            headers={"x-livekit-token": livekit_token})
+
+
+async def chat_burst(bench: Bench, user: dict, i: int, options: dict):
+    """Everyone in the concert sends messages, some also scroll the chat"""
+    sid = bench.seeded["concert"]
+    livekit_token = await bench.join(user, sid, "setup: ")
+    if not livekit_token:
+        return
+    headers = {"x-livekit-token": livekit_token}
+    for n in range(options["chat_messages"]):
+        await bench.request("POST /api/stage/<sid>/chat", "POST", f"/api/stage/{sid}/chat", user["token"],
+                            headers=dict(headers), json={"message": f"message {n} from {i}"})
+        if (i + n) % 10 == 0:
+            await bench.request("GET /api/stage/<sid>/chat", "GET", f"/api/stage/{sid}/chat", user["token"],
+                                headers=dict(headers))
+
+
+async def listing_browse(bench: Bench, user: dict, i: int, options: dict):
+    """Half the visitors browse anonymously, the rest are logged in and also see their private stages"""
+    token = user["token"] if i % 2 else None
+    cursor = None
+    for _ in range(3):
+        res = await bench.request("GET /api/stages/", "GET", "/api/stages/", params={
+            "limit": 20, **({"cursor": cursor} if cursor else {})
+        })
+        cursor = res.headers.get("x-next-cursor") if res.status_code == 200 else None
+        if not cursor:
+            break
+    if token:
+        await bench.request("GET /api/stages/all", "GET", "/api/stages/all", token, params={"limit": 20})
+    owner = bench.seeded["users"][i % len(bench.seeded["users"])]["id"]
+    await bench.request("GET /api/stages/by/<uid>", "GET", f"/api/stages/by/{owner}", token)
+
+
+async def login(bench: Bench, user: dict, i: int, options: dict):
+    """Users sign in with (fake) GitHub: OAuth redirect, callback and code exchange"""
+    res = await bench.request("GET /api/auth/<provider>/oauth", "GET", "/api/auth/github/oauth")
+    state = parse_qs(urlparse(res.headers.get("location", "")).query).get("state")
+    if not state:
+        return
+    res = await bench.request("GET /api/auth/<provider>/callback", "GET", "/api/auth/github/callback", params={
+        "code": f"{options['run_id']}-login-{i}", "state": state[0]
+    })
+    code = parse_qs(urlparse(res.headers.get("location", "")).query).get("code")
+    if code:
+        await bench.request("POST /api/auth/refresh/token", "POST", "/api/auth/refresh/token",
+                            json={"code": code[0]})
+
+
+def summarize(samples: list[Sample], duration: float) -> dict:
+    routes: dict[str, list[Sample]] = {}
+    for sample in samples:
+        routes.setdefault(sample.route, []).append(sample)
+    summary = {}
+    for route, route_samples in sorted(routes.items()):
+        latencies = sorted(sample.latency * 1000 for sample in route_samples)
+        summary[route] = {
+            "requests": len(route_samples),
+            "errors": sum(1 for sample in route_samples if not 200 <= sample.status < 400),
+            "throughput": round(len(route_samples) / duration, 2),
+            "mean_ms": round(sum(latencies) / len(latencies), 3),
+            "p50_ms": round(percentile(latencies, 50), 3),
+            "p95_ms": round(percentile(latencies, 95), 3),
+            "p99_ms": round(percentile(latencies, 99), 3),
+            "max_ms": round(latencies[-1], 3),
+        }
+    return summary
+
+
+async def run_mix(name: str, base_url: str, seeded: dict, options: dict) -> dict:
+    scenario = globals()[name]
+    semaphore = asyncio.Semaphore(options["concurrency"])
+    async with httpx.AsyncClient(base_url=base_url, timeout=options["timeout"], limits=httpx.Limits(
+            max_connections=options["concurrency"], max_keepalive_connections=options["concurrency"])) as http:
+        bench = Bench(http, seeded)
+
+        async def virtual_user(i: int):
+            async with semaphore:
+                try:
+                    await scenario(bench, seeded["users"][i % len(seeded["users"])], i, options)
+                except httpx.HTTPError:
+                    pass  # recorded as a failed sample
+
+        start = time.perf_counter()
+        await asyncio.gather(*(virtual_user(i) for i in range(options["users"])))
+        duration = time.perf_counter() - start
+
+    measured = [sample for sample in bench.samples if not sample.route.startswith("setup: ")]
+    return {
+        "description": scenario.__doc__,
+        "duration_s": round(duration, 3),
+        "requests": len(measured),
+        "errors": sum(1 for sample in measured if not 200 <= sample.status < 400),
+        "throughput": round(len(measured) / duration, 2) if duration else 0,
+        "routes": summarize(measured, duration),
+    }
+
+
+async def run_mixes(mixes: list[str], base_url: str, seeded: dict, options: dict) -> dict:
+    results = {}
+    for name in mixes:
+        results[name] = await run_mix(name, base_url, seeded, options)
+        print(f"{name}: {results[name]['requests']} requests in {results[name]['duration_s']}s, "
+              f"{results[name]['throughput']} req/s, {results[name]['errors']} errors", file=sys.stderr)
+    return results
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mix", default=",".join(MIXES), help=f"comma separated mixes to run, of {', '.join(MIXES)}")
+    parser.add_argument("--users", type=int, default=200, help="virtual users per mix")
+    parser.add_argument("--concurrency", type=int, default=100, help="virtual users active at once")
+    parser.add_argument("--chat-messages", type=int, default=5, help="messages each user sends in chat_burst")
+    parser.add_argument("--stages", type=int, default=100, help="stages to create besides the concert")
+    parser.add_argument("--messages", type=int, default=200, help="chat messages already in the concert")
+    parser.add_argument("--database-url", help="a local MongoDB to use instead of the in-memory fake")
+    parser.add_argument("--db-latency", type=float, default=1, help="ms added to every fake database query")
+    parser.add_argument("--livekit-latency", type=float, default=5, help="ms added to every fake LiveKit call")
+    parser.add_argument("--b2-latency", type=float, default=50, help="ms added to every fake B2 upload")
+    parser.add_argument("--github-latency", type=float, default=100, help="ms added to every fake GitHub call")
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--timeout", type=float, default=30, help="seconds before a request counts as failed")
+    parser.add_argument("--output", help="file to write the results to, instead of stdout")
+    args = parser.parse_args(argv)
+
+    mixes = [mix.strip() for mix in args.mix.split(",") if mix.strip()]
+    unknown = set(mixes) - set(MIXES)
+    if unknown:
+        parser.error(f"unknown mix: {', '.join(sorted(unknown))}")
+
+    options = {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "chat_messages": args.chat_messages,
+        "stages": args.stages,
+        "messages": args.messages,
+        "database_url": args.database_url,
+        "db_latency": args.db_latency / 1000,
+        "livekit_latency": args.livekit_latency / 1000,
+        "b2_latency": args.b2_latency / 1000,
+        "github_latency": args.github_latency / 1000,
+        "port": args.port,
+        "timeout": args.timeout,
+        "run_id": f"bench{int(time.time())}",
+    }
+
+    ctx = multiprocessing.get_context("spawn")
+    conn, child_conn = ctx.Pipe()
+    server = ctx.Process(target=run_server, args=(options, child_conn), daemon=True)
+    server.start()
+    try:
+        if not conn.poll(120):
+            raise RuntimeError("The server did not start in time")
+        seeded = conn.recv()
+        results = asyncio.run(run_mixes(mixes, f"http://127.0.0.1:{args.port}", seeded, options))
+        conn.send("stop")
+        server_stats = conn.recv() if conn.poll(30) else None
+    finally:
+        server.join(30)
+        if server.is_alive():
+            server.terminate()
+
+    report = {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": {key: value for key, value in options.items() if key != "database_url"}
+                   | {"database": "mongodb" if args.database_url else "fake"},
+        "env": {key: value for key, value in os.environ.items()
+                if key in TUNABLES or key.startswith(TUNABLE_PREFIXES)},
+        "mixes": results,
+        "server": server_stats,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,42 +1,121 @@
-from sanic import file
+from sanic import Request
 from sanic.exceptions import NotFound
+from sanic.log import logger
 import pathlib
 import os
 
 from .application import app
 from .routers import routers
+from .util import b2, metrics, passwords, tracing
+from .util.access import access_index
+from .util.auth import providers
+from .util.auth.tokens import user_cache
+from .util.chat_buffer import chat_buffer
+from .util.chat_writer import chat_writer
 from .util.db import db
+from .util.kv import kv
+from .util.livekit.client import client as livekit_client
+from .util.livekit.token import verified_tokens, issued_tokens
+from .util.reaper import reaper
+from .util.response_cache import response_cache
+from .util.static import StaticFiles
 
 STATIC_DIR = str(pathlib.Path(__file__).parent.parent / "static")
 
 
 @app.listener("before_server_start")
 async def setup_db(app, loop):  # noqa
-    print("Connected to database")
     await db.connect()
+    logger.info("Connected to database")
 
 
 @app.listener("after_server_stop")
 async def close_db(app, loop):  # noqa
-    print("Disconnected from database")
     await db.disconnect()
+    logger.info("Disconnected from database")
+
+
+@app.listener("before_server_start")
+async def setup_chat_writer(app, loop):  # noqa
+    chat_writer.start()
+
+
+# after_server_stop listeners run in reverse order, so waiting messages are written before the database disconnects
+@app.listener("after_server_stop")
+async def close_chat_writer(app, loop):  # noqa
+    logger.info("Writing %d waiting chat messages", chat_writer.depth, extra={"waiting": chat_writer.depth})
+    await chat_writer.stop()
+
+
+@app.listener("after_server_stop")
+async def close_b2(app, loop):  # noqa
+    await loop.run_in_executor(None, b2.shutdown)
+
+
+@app.listener("after_server_stop")
+async def close_password_pool(app, loop):  # noqa
+    await loop.run_in_executor(None, passwords.shutdown)
+
+
+@app.listener("before_server_start")
+async def setup_livekit(app, loop):  # noqa
+    await livekit_client.connect()
+
+
+@app.listener("after_server_stop")
+async def close_livekit(app, loop):  # noqa
+    await livekit_client.close()
+
+
+@app.listener("before_server_start")
+async def setup_oauth_http(app, loop):  # noqa
+    providers.get_http()
+
+
+@app.listener("after_server_stop")
+async def close_oauth_http(app, loop):  # noqa
+    await providers.close_http()
+
+
+@app.listener("after_server_stop")
+async def close_kv(app, loop):  # noqa
+    await kv.close()
+
+
+@app.listener("before_server_start")
+async def setup_reaper(app, loop):  # noqa
+    reaper.start()
+
+
+@app.listener("after_server_stop")
+async def close_reaper(app, loop):  # noqa
+    await reaper.stop()
 
 app.blueprint(routers)
+metrics.setup(app)
+metrics.watch_cache("users", user_cache)
+metrics.watch_cache("stage_access", access_index)
+metrics.watch_cache("chat", chat_buffer)
+metrics.watch_cache("livekit_verified_tokens", verified_tokens)
+metrics.watch_cache("livekit_issued_tokens", issued_tokens)
+metrics.watch_cache("responses", response_cache)
+tracing.setup(app)
 
 
-print(os.path.exists(STATIC_DIR))
 if os.path.exists(STATIC_DIR):
-    app.static("/", STATIC_DIR, name="serve files")
-
-    @app.get("/")
-    async def serve_index_html(_):
-        return await file(os.path.join(STATIC_DIR, "index.html"), max_age=7 * 24 * 60 * 60)
+    static_files = StaticFiles(STATIC_DIR)
 
-    @app.get("/favicon.png")
-    async def serve_favicon(_):
-        return await file(os.path.join(STATIC_DIR, "favicon.png"), max_age=7 * 24 * 60 * 60)
+    @app.listener("before_server_start")
+    async def load_static_files(app, loop):  # noqa
+        static_files.load()
 
-    @app.exception(NotFound)
-    async def serve_index_html(_1, _2):
-        print("404")
-        return await file(os.path.join(STATIC_DIR, "index.html"), max_age=7 * 24 * 60 * 60)
+    @app.get("/")
+    @app.get("/<path:path>")
+    async def serve_static(req: Request, path: str = ""):
+        if path == "api" or path.startswith("api/"):
+            raise NotFound(f"Requested URL {req.path} not found")
+        # unknown paths are routes of the single page app, which index.html takes care of
+        asset = static_files.get(path) or static_files.get("index.html")
+        if asset is None:
+            raise NotFound(f"Requested URL {req.path} not found")
+        return static_files.response(req, asset)
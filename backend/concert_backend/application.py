@@ -2,7 +2,13 @@ import os
 
 from sanic import Sanic
 
-app = Sanic("concert_backend")
+from .util.encoding import dumps
+from .util.logs import use_json_logs
+
+app = Sanic("concert_backend", dumps=dumps)
+
+if os.getenv("LOG_FORMAT") == "json":
+    use_json_logs("sanic.root", "sanic.error", "sanic.access")
 
 if os.getenv("DEV") or bool(int(os.getenv("ENABLE_CORS", 0))):
     app.config.CORS = True
@@ -1,33 +1,29 @@
 import os
-from datetime import datetime, timedelta
-from json import loads
 from urllib.parse import urlparse
 from uuid import uuid4 as uuid
 
-from sanic import Blueprint, Request, json, redirect
+from sanic import Blueprint, Request, HTTPResponse, json, redirect
 
 from concert_backend.util.auth import auth
 from concert_backend.util.auth.providers import providers
-from concert_backend.util.auth.tokens import generate_refresh_token, get_access_token_from_refresh_token
+from concert_backend.util.auth.tokens import generate_refresh_token, refresh_access_token, revoke_refresh_token, \
+    invalidate_user
 from concert_backend.util.db import db
+from concert_backend.util.kv import kv
 
 router = Blueprint("auth", "/api/auth")
 
-
-async def save_state(state: str, next_="/"):
-    await db.oauthstates.create({"state": state, "next": next_})
+STATE_TTL = 15 * 60
+CODE_TTL = 5 * 60
 
 
-async def delete_state(state: str):
-    await db.oauthstates.delete({"state": state})
+async def save_state(state: str, next_="/"):
+    await kv.set(f"oauth_state:{state}", next_, STATE_TTL)
 
 
-async def check_state(state: str):
-    data = await db.oauthstates.find_unique({"state": state})
-    if data and data.created_at.replace(tzinfo=None) < (datetime.utcnow() - timedelta(minutes=15)).replace(
-            tzinfo=None):
-        return False
-    return data.next if data else None
+async def consume_state(state: str):
+    """Returns the next url saved with `state` and deletes it in the same step, so a state is only accepted once"""
+    return await kv.pop(f"oauth_state:{state}")
 
 
 @router.get("/<provider:str>/oauth")
@@ -56,7 +52,7 @@ async def callback(req: Request, provider: str):
     state = req.args.get("state")
     if not state:
         return json({"message": "No state provided"}, status=400)
-    next_: str = await check_state(state)
+    next_: str = await consume_state(state)
     if not next_:
         return json({"message": "Invalid state"}, status=400)
     token = await provider_cls.get_token(code)
@@ -64,7 +60,7 @@ async def callback(req: Request, provider: str):
         return json({"message": token}, status=400)
     user_data = await provider_cls.get_user_info(token["access_token"], token["refresh_token"])
     if type(user_data) == str:
-        return json({"message": token}, status=400)
+        return json({"message": user_data}, status=400)
     user = await db.users.find_unique({"email": user_data["email"]})
     if not user:
         user = await db.users.create(user_data)
@@ -77,17 +73,33 @@ async def callback(req: Request, provider: str):
             return json({
                 "message": "Invalid account. Please contact support. Your email does not match your \""
                            + user.provider + "\" id"}, status=400)
-    await delete_state(state)
-
-    code = await db.oauthcodes.create({"user": {"connect": {"id": user.id}}})
+        # the username and avatar may have been changed on the provider since the last login
+        changes = {field: user_data[field] for field in ("username", "avatar_url")
+                   if getattr(user, field) != user_data[field]}
+        if changes:
+            user = await db.users.update(changes, where={"id": user.id})
+            invalidate_user(user.id)
+
+    code = str(uuid())
+    await kv.set(f"oauth_code:{code}", user.id, CODE_TTL)
     return redirect(
-        f"{os.getenv('FRONTEND_URL')}/{next_.replace('/', '', 1) if next_.startswith('/') else next_}?code={code.code}")
+        f"{os.getenv('FRONTEND_URL')}/{next_.replace('/', '', 1) if next_.startswith('/') else next_}?code={code}")
 
 
 @router.get("/me")
 @auth()
 async def get_user(req: Request):
-    return json({"user": loads(req.ctx.safe_user.json())})
+    return json({"user": req.ctx.safe_user})
+
+
+def set_refresh_token_cookie(res: HTTPResponse, refresh_token: str):
+    res.cookies["refresh_token"] = refresh_token
+    res.cookies["refresh_token"]["httponly"] = True
+    res.cookies["refresh_token"]["samesite"] = not bool(os.getenv("DEV"))
+    res.cookies["refresh_token"]["secure"] = os.getenv("SELF_URL").startswith("https://")
+    res.cookies["refresh_token"]["max-age"] = 60 * 60 * 24 * 30
+    res.cookies["refresh_token"]["path"] = "/api/auth/refresh"
+    res.cookies["refresh_token"]["domain"] = urlparse(os.getenv("SELF_URL")).hostname
 
 
 @router.post("/refresh/token")
@@ -97,42 +109,37 @@ async def set_token_from_code(req: Request):
     code = req.json.get("code")
     if not code:
         return json({"message": "No code provided"}, status=400)
-    code = await db.oauthcodes.find_unique({"code": code})
-    if not code:
+    user_id = await kv.pop(f"oauth_code:{code}")
+    if not user_id:
         return json({"message": "Invalid code"}, status=400)
-    await db.oauthcodes.delete({"code": code.code})
-    user = await db.users.find_unique({"id": code.user_id})
+    user = await db.users.find_unique({"id": user_id})
     if not user:
         return json({"message": "User not found"}, status=400)
 
     refresh_token = await generate_refresh_token(user)
 
     res = json({"refresh_token": refresh_token})
-    res.cookies["refresh_token"] = refresh_token
-    res.cookies["refresh_token"]["httponly"] = True
-    res.cookies["refresh_token"]["samesite"] = not bool(os.getenv("DEV"))
-    res.cookies["refresh_token"]["secure"] = os.getenv("SELF_URL").startswith("https://")
-    res.cookies["refresh_token"]["max-age"] = 60 * 60 * 24 * 30
-    res.cookies["refresh_token"]["path"] = "/api/auth/refresh"
-    res.cookies["refresh_token"]["domain"] = urlparse(os.getenv("SELF_URL")).hostname
-
+    set_refresh_token_cookie(res, refresh_token)
     return res
 
 
 @router.route("/refresh", methods=["GET", "POST"])
 async def refresh(req: Request):
-    print(req.cookies)
     token_from_cookie = req.cookies.get("refresh_token")
     if not token_from_cookie or type(token_from_cookie) != str:
         res = json({"message": "Unauthorized"}, status=401)
         del res.cookies["refresh_token"]
         return res
-    token = await get_access_token_from_refresh_token(token_from_cookie)
-    if not token:
+    tokens = await refresh_access_token(token_from_cookie)
+    if not tokens:
         res = json({"message": "Invalid refresh token"}, status=400)
         del res.cookies["refresh_token"]
         return res
-    return json({"access_token": token, "refresh_token": token_from_cookie})
+    token, refresh_token = tokens
+    res = json({"access_token": token, "refresh_token": refresh_token})
+    if refresh_token != token_from_cookie:
+        set_refresh_token_cookie(res, refresh_token)
+    return res
 
 
 @router.route("/refresh/invalidate", methods=["GET", "POST"])
@@ -142,7 +149,7 @@ async def invalidate(req: Request):
         res = json({"message": "Unauthorized"}, status=401)
         del res.cookies["refresh_token"]
         return res
-    await db.refreshtokens.delete({"token": token_from_cookie})
+    await revoke_refresh_token(token_from_cookie)
     res = json({"message": "Success"})
     del res.cookies["refresh_token"]
     return res
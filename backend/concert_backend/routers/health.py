@@ -0,0 +1,21 @@
+import os
+
+from sanic import Blueprint, Request, json
+
+from concert_backend.util.chat_writer import chat_writer
+from concert_backend.util.db import db
+
+router = Blueprint("health", "/api/health")
+
+
+@router.get("/")
+async def health(req: Request):
+    """Reports whether the worker that handled the request can serve traffic"""
+    connected = db.is_connected()
+    return json({
+        "status": "ok" if connected else "unavailable",
+        "worker": os.getenv("SANIC_WORKER_NAME"),
+        "pid": os.getpid(),
+        "db": connected,
+        "pending_chat_writes": chat_writer.depth
+    }, status=200 if connected else 503)
@@ -1,12 +1,11 @@
-from json import loads
-
-from prisma.partials import SafeStage
 from pydantic import BaseModel
 from sanic import Blueprint, Request, json
 from sanic_ext import validate
 
+from concert_backend.util.access import access_index
 from concert_backend.util.auth import auth
 from concert_backend.util.db import db
+from concert_backend.util.encoding import safe_stage
 
 router = Blueprint("invites", url_prefix="/api/invites")
 
@@ -15,18 +14,16 @@ router = Blueprint("invites", url_prefix="/api/invites")
 @auth()
 async def get_all_invites(req: Request):
     invites = await db.invites.find_many(where={"user_id": req.ctx.user.id}, include={"stage": True})
-    return json({"invites": [{**loads(invite.json()), "stage": loads(SafeStage(**invite.stage.dict()).json())} for
-                             invite in invites]})
+    return json({"invites": [{**dict(invite), "stage": safe_stage(invite.stage)} for invite in invites]})
 
 
 @router.get("/<iid:str>")
 @auth()
 async def get_invite_by_id(req: Request, iid: str):
     invite = await db.invites.find_first(where={"id": iid, "user_id": req.ctx.user.id}, include={"stage": True})
-    print(invite)
     if not invite:
         return json({"message": "Invite not found"}, status=404)
-    return json({"invite": {**loads(invite.json()), "stage": loads(SafeStage(**invite.stage.dict()).json())}})
+    return json({"invite": {**dict(invite), "stage": safe_stage(invite.stage)}})
 
 
 class CreateInviteRequest(BaseModel):
@@ -45,7 +42,58 @@ async def create_invite(req: Request, body: CreateInviteRequest):
         return json({"message": "Stage not found"}, status=404)
     invite = await db.invites.create({"user_id": body.user_id, "stage_id": stage.id},
                                      include={"stage": True})
-    return json({"invite": {**loads(invite.json()), "stage": loads(SafeStage(**invite.stage.dict()).json())}})
+    await access_index.add_invites(invite.stage_id, invite.user_id)
+    return json({"invite": {**dict(invite), "stage": safe_stage(invite.stage)}})
+
+
+MAX_BULK_INVITES = 1000
+
+
+class BulkInviteRequest(BaseModel):
+    stage_id: str = ...
+    user_ids: list[str] = ...
+
+
+@router.post("/bulk")
+@auth()
+@validate(json=BulkInviteRequest)
+async def create_invites(req: Request, body: BulkInviteRequest):
+    """Invites many users to a stage at once. Every requested user gets a result with one of the statuses
+    `invited`, `already_invited`, `not_found` or `self`."""
+    user_ids = list(dict.fromkeys(body.user_ids))
+    if not user_ids:
+        return json({"message": "No users to invite"}, status=400)
+    if len(user_ids) > MAX_BULK_INVITES:
+        return json({"message": f"At most {MAX_BULK_INVITES} users can be invited at once"}, status=400)
+    stage = await db.stages.find_first(where={"id": body.stage_id, "owner_id": req.ctx.user.id})
+    if not stage:
+        return json({"message": "Stage not found"}, status=404)
+
+    candidates = [uid for uid in user_ids if uid != req.ctx.user.id]
+    existing = {invite.user_id: invite.id for invite in await db.invites.find_many(
+        where={"stage_id": stage.id, "user_id": {"in": candidates}})} if candidates else {}
+    new = [uid for uid in candidates if uid not in existing]
+    found = {user.id for user in await db.users.find_many(where={"id": {"in": new}})} if new else set()
+    to_create = [uid for uid in new if uid in found]
+
+    created = {}
+    if to_create:
+        await db.invites.create_many([{"stage_id": stage.id, "user_id": uid} for uid in to_create])
+        created = {invite.user_id: invite.id for invite in await db.invites.find_many(
+            where={"stage_id": stage.id, "user_id": {"in": to_create}})}
+        await access_index.add_invites(stage.id, *to_create)
+
+    results = []
+    for uid in user_ids:
+        if uid == req.ctx.user.id:
+            results.append({"user_id": uid, "status": "self", "invite_id": None})
+        elif uid in existing:
+            results.append({"user_id": uid, "status": "already_invited", "invite_id": existing[uid]})
+        elif uid in created:
+            results.append({"user_id": uid, "status": "invited", "invite_id": created[uid]})
+        else:
+            results.append({"user_id": uid, "status": "not_found", "invite_id": None})
+    return json({"stage": safe_stage(stage), "invited": len(created), "results": results})
 
 
 @router.delete("/<iid:str>")
@@ -55,4 +103,5 @@ async def delete_invite(req: Request, iid: str):
     if not invite:
         return json({"message": "Invite not found"}, status=404)
     await db.invites.delete(where={"id": iid})
-    return json({"invite": {**loads(invite.json()), "stage": loads(SafeStage(**invite.stage.dict()).json())}})
+    await access_index.remove_invite(invite.stage_id, invite.user_id)
+    return json({"invite": {**dict(invite), "stage": safe_stage(invite.stage)}})
@@ -1,18 +1,29 @@
+import asyncio
 from dataclasses import asdict
-from json import loads, dumps
 
 from livekit import DataPacketKind, ParticipantPermission
+from prisma.models import ChatMessages
 from sanic import Blueprint, Request, json
+from sanic.log import logger
 from sanic.request import File
 
+from concert_backend.util.access import access_index
 from concert_backend.util.auth import auth
-from concert_backend.util.b2 import upload_file
+from concert_backend.util.b2 import upload_file, upload_stream, StreamPipe
+from concert_backend.util.chat_buffer import chat_buffer
+from concert_backend.util.chat_writer import chat_writer
 from concert_backend.util.db import db
+from concert_backend.util.encoding import dumps
 from concert_backend.util.livekit.client import client
-from concert_backend.util.livekit.token import create_livekit_token, livekit, ClaimGrants
+from concert_backend.util.livekit.token import get_livekit_token, livekit, ClaimGrants
 
 router = Blueprint("stage", "/api/stage/<sid:str>")
 
+CHAT_PAGE_SIZE = 100
+MAX_FILE_SIZE = 2 * 1024 * 1024
+# room for the boundaries and part headers around the file in a multipart body
+MULTIPART_OVERHEAD = 16 * 1024
+
 
 @router.get("/token")
 @auth()
@@ -20,16 +31,11 @@ async def get_stage_token(req: Request, sid: str):
     uid = req.ctx.user.id if hasattr(req.ctx, "user") else None
     if not uid:
         return json({"message": "Unauthorized"}, status=401)
-    stage = await db.stages.find_first(
-        where={"id": sid, "OR": [{"invites": {"some": {"user_id": uid}}}, {"owner_id": uid}, {"private": False}]},
-        include={"owner": True}
-    )
-    if not uid and stage.private:
-        return json({"message": "Stage not found. You may need to login to access private stages"}, status=404)
-    if not stage:
+    stage = await access_index.get(sid)
+    if not stage or not stage.allows(uid):
         return json({"message": "Stage not found. You may need to login to access private stages"}, status=404)
 
-    token = create_livekit_token(req.ctx.user, stage, stage.owner_id == req.ctx.user.id)
+    token = get_livekit_token(req.ctx.user, stage, stage.owner_id == req.ctx.user.id)
     return json({"token": token})
 
 
@@ -43,6 +49,44 @@ async def get_stage_info(req: Request, sid: str):
     return json(asdict(req.ctx.grants))
 
 
+def chat_key(msg: ChatMessages):
+    return msg.created_at, msg.id
+
+
+async def get_chat_page(sid: str, limit: int, cursor: str | None = None, newer=False) -> list[ChatMessages]:
+    """Fetches a page of chat history, oldest message first.
+
+    Pages are keyset-paginated on (created_at, id), backed by the (stage_id, created_at) index. Without a cursor
+    the newest page is returned. With one, the page of messages right before it (or after it if `newer`) is.
+    """
+    where = {"stage_id": sid}
+    position = {"cursor": {"id": cursor}, "skip": 1} if cursor else {}
+    # a message still waiting to be written can't be a Prisma cursor, the page starts from its key instead
+    anchor = chat_writer.find_pending(cursor) if cursor else None
+    if anchor:
+        op = "gt" if newer else "lt"
+        where["OR"] = [{"created_at": {op: anchor.created_at}},
+                       {"created_at": anchor.created_at, "id": {op: anchor.id}}]
+        position = {}
+    messages = await db.chatmessages.find_many(
+        where=where,
+        include={"user": True},
+        take=limit,
+        **position,
+        order=[{"created_at": "asc"}, {"id": "asc"}] if newer else [{"created_at": "desc"}, {"id": "desc"}]
+    )
+    if anchor:
+        # the messages around it may not be written either
+        ids = {msg.id for msg in messages}
+        for msg in chat_writer.pending(sid):
+            if msg.id not in ids and (chat_key(msg) > chat_key(anchor) if newer else chat_key(msg) < chat_key(anchor)):
+                messages.append(msg)
+        messages = sorted(messages, key=chat_key, reverse=not newer)[:limit]
+    if not newer:
+        messages.reverse()
+    return messages
+
+
 @router.get("/chat")
 @auth()
 @livekit()
@@ -51,9 +95,36 @@ async def get_chat(request: Request, sid: str):
     if grants.video["room"] != sid:
         return json({"message": "Invalid livekit token"}, status=401)
 
-    messages = await db.chatmessages.find_many(where={"stage_id": sid}, include={"user": True}, take=100,
-                                               order={"created_at": "asc"})
-    return json({"messages": [loads(x.json()) for x in messages]})
+    try:
+        limit = min(max(int(request.args.get("limit", CHAT_PAGE_SIZE)), 1), CHAT_PAGE_SIZE)
+    except ValueError:
+        return json({"message": "Invalid limit"}, status=400)
+    before = request.args.get("before")
+    after = request.args.get("after")
+    if before and after:
+        return json({"message": "Only one of before and after can be given"}, status=400)
+
+    cursor = before or after
+    if not cursor and limit <= chat_buffer.size:
+        messages = chat_buffer.get(sid)
+        if messages is None:
+            messages = await get_chat_page(sid, chat_buffer.size)
+            # messages that are still waiting to be written are not in the database yet
+            pending = chat_writer.pending(sid)
+            if pending:
+                ids = {msg.id for msg in messages}
+                messages = sorted([*messages, *(msg for msg in pending if msg.id not in ids)],
+                                  key=lambda msg: msg.created_at)[-chat_buffer.size:]
+            chat_buffer.load(sid, messages)
+        messages = messages[-limit:]
+    else:
+        messages = await get_chat_page(sid, limit, cursor, bool(after))
+    has_more = len(messages) == limit
+    return json({
+        "messages": messages,
+        "before": messages[0].id if messages and (after or has_more) else None,
+        "after": messages[-1].id if messages else after,
+    })
 
 
 @router.post("/chat")
@@ -73,42 +144,105 @@ async def chat(request: Request, sid: str):
     if len(body["message"].strip()) > 512:
         return json({"message": "Message must be less than 512 chars"}, status=400)
 
-    msg = await db.chatmessages.create({
+    msg = await chat_writer.create({
         "type": "TEXT",
         "message_data": body["message"].strip(),
         "stage_id": sid,
-        "user_id": request.ctx.user.id,
-    }, include={"user": True})
+    }, request.ctx.user)
+    chat_buffer.append(sid, msg)
 
-    client.send_data(sid, dumps({"type": "CHAT", "data": loads(msg.json())}).encode(), DataPacketKind.RELIABLE, [])
+    await client.send_data(sid, dumps({"type": "CHAT", "data": msg}), DataPacketKind.RELIABLE, [])
 
     return json({"id": msg.id})
 
 
-@router.post("/chat/file")
+async def read_body(request: Request, limit: int) -> bytes | None:
+    """Reads a streamed body, giving up as soon as more than `limit` bytes arrive"""
+    chunks = []
+    received = 0
+    while chunk := await request.stream.read():
+        received += len(chunk)
+        if received > limit:
+            return None
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+async def pipe_body(request: Request, length: int, filename: str, content_type: str) -> str | None:
+    """Uploads a streamed body to B2 chunk by chunk while it arrives. Returns None if it is not `length` bytes."""
+    pipe = StreamPipe()
+    upload = asyncio.ensure_future(upload_stream(pipe, length, filename, content_type))
+    received = 0
+    try:
+        while chunk := await request.stream.read():
+            received += len(chunk)
+            if received > length:
+                return None
+            await pipe.feed(chunk)
+        if received != length:
+            return None
+        await pipe.feed(None)
+        return await upload
+    except BrokenPipeError:
+        # the upload failed before the body was fully sent, surface its error instead
+        return await upload
+    finally:
+        if not upload.done():
+            pipe.abort(ConnectionAbortedError("The request body was not fully received"))
+            upload.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+
+@router.post("/chat/file", stream=True)
 @auth()
 @livekit()
 async def chat_file(request: Request, sid: str):
+    """Accepts either a multipart form with a `file` field, or the raw file as the body with its name in the
+    `x-filename` header (or `filename` query parameter). Raw bodies are streamed to B2 without being buffered,
+    multipart forms are read into memory (at most 2MiB) first."""
     grants: ClaimGrants = request.ctx.grants
     if grants.video["room"] != sid:
         return json({"message": "Invalid livekit token"}, status=401)
 
-    file: File = request.files.get("file")
-    if not file:
-        return json({"message": "Missing file"}, status=400)
-    if len(file.body) > 2 * 1024 * 1024:
-        return json({"message": "File must be less than 2MiB"}, status=400)
-
-    url = upload_file(file.body, file.name, file.type)
-
-    msg = await db.chatmessages.create({
+    try:
+        length = int(request.headers.get("content-length", 0))
+    except ValueError:
+        return json({"message": "Invalid Content-Length"}, status=400)
+
+    if request.content_type.startswith("multipart/form-data"):
+        if length > MAX_FILE_SIZE + MULTIPART_OVERHEAD:
+            return json({"message": "File must be less than 2MiB"}, status=400)
+        body = await read_body(request, MAX_FILE_SIZE + MULTIPART_OVERHEAD)
+        if body is None:
+            return json({"message": "File must be less than 2MiB"}, status=400)
+        request.body = body
+        file: File = request.files.get("file")
+        if not file:
+            return json({"message": "Missing file"}, status=400)
+        if len(file.body) > MAX_FILE_SIZE:
+            return json({"message": "File must be less than 2MiB"}, status=400)
+
+        url = await upload_file(file.body, file.name, file.type)
+    else:
+        filename = request.headers.get("x-filename") or request.args.get("filename")
+        if not filename:
+            return json({"message": "Missing file name"}, status=400)
+        if not length:
+            return json({"message": "Missing Content-Length"}, status=411)
+        if length > MAX_FILE_SIZE:
+            return json({"message": "File must be less than 2MiB"}, status=400)
+
+        url = await pipe_body(request, length, filename, request.content_type)
+        if not url:
+            return json({"message": "The body does not match its Content-Length"}, status=400)
+
+    msg = await chat_writer.create({
         "type": "FILE",
         "message_data": url,
         "stage_id": sid,
-        "user_id": request.ctx.user.id,
-    })
+    }, request.ctx.user)
+    chat_buffer.append(sid, msg)
 
-    client.send_data(sid, dumps({"type": "CHAT", "data": loads(msg.json())}).encode(), DataPacketKind.RELIABLE, [])
+    await client.send_data(sid, dumps({"type": "CHAT", "data": msg}), DataPacketKind.RELIABLE, [])
 
     return json({"id": msg.id})
 
@@ -121,14 +255,14 @@ async def request_to_speak(request: Request, sid: str):
     if grants.video["room"] != sid:
         return json({"message": "Invalid livekit token"}, status=401)
 
-    msg = await db.chatmessages.create({
+    msg = await chat_writer.create({
         "type": "EVENT",
         "message_data": "REQUEST_TO_SPEAK",
         "stage_id": sid,
-        "user_id": request.ctx.user.id,
-    }, include={"user": True})
+    }, request.ctx.user)
+    chat_buffer.append(sid, msg)
 
-    client.send_data(sid, dumps({"type": "CHAT", "data": loads(msg.json())}).encode(), DataPacketKind.RELIABLE, [])
+    await client.send_data(sid, dumps({"type": "CHAT", "data": msg}), DataPacketKind.RELIABLE, [])
 
     return json({"message": "Request sent"})
 
@@ -158,16 +292,16 @@ async def toggle_speaker(request: Request, sid: str, is_speaker: bool):
         recorder=False,
         hidden=False
     )
-    client.update_participant(sid, user.id, permission=perm)
+    await client.update_participant(sid, user.id, permission=perm)
 
-    msg = await db.chatmessages.create({
+    msg = await chat_writer.create({
         "type": "EVENT",
         "message_data": "MADE_SPEAKER" if is_speaker else "MADE_LISTENER",
         "stage_id": sid,
-        "user_id": user.id,
-    }, include={"user": True})
+    }, user)
+    chat_buffer.append(sid, msg)
 
-    client.send_data(sid, dumps({"type": "CHAT", "data": loads(msg.json())}).encode(), DataPacketKind.RELIABLE, [])
+    await client.send_data(sid, dumps({"type": "CHAT", "data": msg}), DataPacketKind.RELIABLE, [])
 
     return json({"message": "Promoted to speaker"})
 
@@ -184,3 +318,79 @@ async def make_speaker(request: Request, sid: str):
 @livekit()
 async def make_listener(request: Request, sid: str):
     return await toggle_speaker(request, sid, False)
+
+
+MAX_SPEAKER_BATCH = 100
+
+
+async def toggle_speakers(request: Request, sid: str, is_speaker: bool):
+    """Makes every user in the body's `user_ids` a speaker (or a listener). Their events are sent in a single
+    CHAT_BATCH data packet."""
+    grants: ClaimGrants = request.ctx.grants
+    if grants.video["room"] != sid:
+        return json({"message": "Invalid livekit token"}, status=401)
+    stage = await access_index.get(sid)
+    if not stage or request.ctx.user.id != stage.owner_id:
+        return json({"message": "You are not the owner"}, status=401)
+
+    body = request.json
+    if not body:
+        return json({"message": "Missing body"}, status=400)
+    user_ids = body.get("user_ids")
+    if type(user_ids) != list or not user_ids or any(type(uid) != str for uid in user_ids):
+        return json({"message": "Missing user_ids"}, status=400)
+    user_ids = list(dict.fromkeys(user_ids))
+    if len(user_ids) > MAX_SPEAKER_BATCH:
+        return json({"message": f"At most {MAX_SPEAKER_BATCH} users can be changed at once"}, status=400)
+
+    users = await db.users.find_many(where={"id": {"in": user_ids}})
+    if not users:
+        return json({"message": "User not found"}, status=404)
+
+    perm = ParticipantPermission(
+        can_subscribe=True,
+        can_publish=is_speaker,
+        can_publish_data=False,
+        recorder=False,
+        hidden=False
+    )
+    results = await asyncio.gather(*(client.update_participant(sid, user.id, permission=perm) for user in users),
+                                   return_exceptions=True)
+    updated = [user for user, result in zip(users, results) if not isinstance(result, BaseException)]
+    failed = [user.id for user, result in zip(users, results) if isinstance(result, BaseException)]
+    if failed:
+        logger.warning("Failed to update %d of %d participants in %s", len(failed), len(users), sid,
+                       extra={"stage_id": sid, "failed": failed})
+    found = {user.id for user in users}
+
+    messages = await chat_writer.create_many([({
+        "type": "EVENT",
+        "message_data": "MADE_SPEAKER" if is_speaker else "MADE_LISTENER",
+        "stage_id": sid,
+    }, user) for user in updated])
+    for msg in messages:
+        chat_buffer.append(sid, msg)
+    if messages:
+        await client.send_data(sid, dumps({"type": "CHAT_BATCH", "data": messages}), DataPacketKind.RELIABLE, [])
+
+    return json({
+        "message": ("Promoted to speaker" if is_speaker else "Demoted to listener") if updated
+        else "No participant could be updated",
+        "updated": [user.id for user in updated],
+        "failed": failed,
+        "not_found": [uid for uid in user_ids if uid not in found],
+    }, status=200 if updated else 502)
+
+
+@router.post("/owner/make_speakers")
+@auth()
+@livekit()
+async def make_speakers(request: Request, sid: str):
+    return await toggle_speakers(request, sid, True)
+
+
+@router.post("/owner/make_listeners")
+@auth()
+@livekit()
+async def make_listeners(request: Request, sid: str):
+    return await toggle_speakers(request, sid, False)
@@ -1,104 +1,109 @@
-from json import loads
 from typing import Any
 
-from bcrypt import hashpw, gensalt
-from prisma.partials import SafeStage, SafeUser
+from prisma.models import Stages
 from pydantic import BaseModel, validator
-from sanic import Blueprint, Request, json
+from sanic import Blueprint, Request, HTTPResponse, json
 from sanic_ext import validate
 
+from concert_backend.util.access import access_index
 from concert_backend.util.auth import auth
+from concert_backend.util.chat_buffer import chat_buffer
 from concert_backend.util.db import db
+from concert_backend.util.encoding import safe_stage
+from concert_backend.util.pagination import Page, InvalidPage
+from concert_backend.util.passwords import hash_password, PoolFull
+from concert_backend.util.response_cache import cached, invalidate
 
 router = Blueprint("stages", "/api/stages")
 
 
+def page_key(req: Request) -> tuple:
+    """The response cache key of a listing: the parsed page, so ?limit=10 and no limit share an entry"""
+    return Page.from_args(req.args).cache_key()
+
+
+@router.exception(PoolFull)
+async def password_pool_full(_1, _2):
+    return json({"message": "Too many stages are being saved right now, please try again"}, status=503,
+                headers={"Retry-After": "1"})
+
+
+async def invalidate_listings(owner_id: str):
+    """Drops the cached public listings a stage of `owner_id` can appear in, on every worker"""
+    await invalidate("public", f"by:{owner_id}")
+
+
+def stage_page(page: Page, stages: list[Stages], key: str | None = None) -> HTTPResponse:
+    """Responds with a page of stages. The cursor of the next page is in the `x-next-cursor` header,
+    and in the body too if the stages are wrapped in an object under `key`."""
+    stages, cursor = page.split(stages)
+    stages = [safe_stage(stage) for stage in stages]
+    res = json({key: stages, "next_cursor": cursor} if key else stages)
+    if cursor:
+        res.headers["x-next-cursor"] = cursor
+    return res
+
+
 @router.get("/")
+@cached(lambda: "public", page_key)
 async def get_public_stages(req: Request):
-    limit = type(req.args.get("limit")) == str and int(req.args.get("limit")) or 10
-    offset = type(req.args.get("offset")) == str and int(req.args.get("offset")) or 0
-    sort = type(req.args.get("sort")) == str and req.args.get("sort") or "created_at"
-    sort_order = type(req.args.get("sort_order")) == str and req.args.get("sort_order").lower()
-    if sort_order not in ("asc", "desc"):
-        sort_order = "desc"
+    try:
+        page = Page.from_args(req.args)
+    except InvalidPage as e:
+        return json({"message": str(e)}, status=400)
 
-    stages = await db.stages.find_many(
-        where={"private": False},
-        take=limit,
-        skip=offset,
-        order={sort: sort_order},
-        include={"owner": True}
-    )
-    return json([loads(SafeStage(**stage.dict()).json()) for stage in stages])
+    stages = await db.stages.find_many(**page.query({"private": False}), include={"owner": True})
+    return stage_page(page, stages)
 
 
 @router.get('/all')
 @auth(False)
 async def get_all_stages(req: Request):
-    limit = type(req.args.get("limit")) == str and int(req.args.get("limit")) or 10
-    offset = type(req.args.get("offset")) == str and int(req.args.get("offset")) or 0
-    sort = type(req.args.get("sort")) == str and req.args.get("sort") or "created_at"
-    sort_order = type(req.args.get("sort_order")) == str and req.args.get("sort_order").lower()
-    if sort_order not in ("asc", "desc"):
-        sort_order = "desc"
+    try:
+        page = Page.from_args(req.args)
+    except InvalidPage as e:
+        return json({"message": str(e)}, status=400)
 
     uid = req.ctx.user.id if hasattr(req.ctx, "user") else None
     stages = await db.stages.find_many(
-        where={"OR": [{"invites": {"some": {"user_id": uid}}}, {"owner_id": uid}, {"private": False}]} if uid else {
-            "private": False},
-        take=limit,
-        skip=offset,
-        order={sort: sort_order},
+        **page.query({"OR": [{"invites": {"some": {"user_id": uid}}}, {"owner_id": uid}, {"private": False}]} if uid
+                     else {"private": False}),
         include={"owner": True}
     )
-    return json({"stages": [loads(SafeStage(**stage.dict()).json()) for stage in stages]})
+    return stage_page(page, stages, "stages")
 
 
 @router.get("/<sid:str>")
 @auth(False)
 async def get_stage_by_id(req: Request, sid: str):
     uid = req.ctx.user.id if hasattr(req.ctx, "user") else None
-    stage = await db.stages.find_first(
-        where={"id": sid,
-               "OR": [{"invites": {"some": {"user_id": uid}}}, {"owner_id": uid}, {"private": False}]} if uid else {
-            "id": sid},
-        include={"owner": True}
-    )
-    if not uid and stage.private:
+    if not await access_index.can_view(uid, sid):
         return json({"message": "Stage not found. You may need to login to access private stages"}, status=404)
+    stage = await db.stages.find_unique(where={"id": sid}, include={"owner": True})
     if not stage:
         return json({"message": "Stage not found. You may need to login to access private stages"}, status=404)
-    return json({"stage": loads(SafeStage(**stage.dict()).json())})
+    return json({"stage": safe_stage(stage)})
 
 
 @router.get('/by/<uid:str>')
+@cached(lambda uid: f"by:{uid}", page_key)
 async def get_stages_by_uid(req: Request, uid: str):
-    limit = type(req.args.get("limit")) == str and int(req.args.get("limit")) or 10
-    offset = type(req.args.get("offset")) == str and int(req.args.get("offset")) or 0
-    sort = type(req.args.get("sort")) == str and req.args.get("sort") or "created_at"
-    sort_order = type(req.args.get("sort_order")) == str and req.args.get("sort_order").lower()
-    if sort_order not in ("asc", "desc"):
-        sort_order = "desc"
+    try:
+        page = Page.from_args(req.args)
+    except InvalidPage as e:
+        return json({"message": str(e)}, status=400)
 
-    stages = await db.stages.find_many(
-        where={"private": False, "owner_id": uid},
-        take=limit,
-        skip=offset,
-        order={sort: sort_order},
-        include={"owner": True}
-    )
-    return json([loads(SafeStage(**stage.dict()).json()) for stage in stages])
+    stages = await db.stages.find_many(**page.query({"private": False, "owner_id": uid}), include={"owner": True})
+    return stage_page(page, stages)
 
 
 @router.get('/all/by/<uid:str>')
 @auth(False)
 async def get_all_stages_by_uid(req: Request, uid: str):
-    limit = type(req.args.get("limit")) == str and int(req.args.get("limit")) or 10
-    offset = type(req.args.get("offset")) == str and int(req.args.get("offset")) or 0
-    sort = type(req.args.get("sort")) == str and req.args.get("sort") or "created_at"
-    sort_order = type(req.args.get("sort_order")) == str and req.args.get("sort_order").lower()
-    if sort_order not in ("asc", "desc"):
-        sort_order = "desc"
+    try:
+        page = Page.from_args(req.args)
+    except InvalidPage as e:
+        return json({"message": str(e)}, status=400)
 
     cuid = req.ctx.user.id if hasattr(req.ctx, "user") else None
     if not cuid:
@@ -107,14 +112,8 @@ async def get_all_stages_by_uid(req: Request, uid: str):
         query = {"owner_id": cuid, "private": False}
     else:
         query = {"invites": {"some": {"user_id": cuid}}, "owner_id": uid, "private": False}
-    stages = await db.stages.find_many(
-        where=query,
-        take=limit,
-        skip=offset,
-        order={sort: sort_order},
-        include={"owner": True}
-    )
-    return json({"stages": [loads(SafeStage(**stage.dict()).json()) for stage in stages]})
+    stages = await db.stages.find_many(**page.query(query), include={"owner": True})
+    return stage_page(page, stages, "stages")
 
 
 class CreateStageRequest(BaseModel):
@@ -170,14 +169,13 @@ class CreateStageRequest(BaseModel):
 async def create_stage(req: Request, body: CreateStageRequest):
     stage = await db.stages.create({
         "name": body.name,
-        "password": hashpw(body.password.encode(), gensalt(12)).decode() if body.password is not None else None,
+        "password": await hash_password(body.password) if body.password is not None else None,
         "color": body.color,
         "private": body.private,
         "owner_id": req.ctx.user.id
     }, include={"owner": True})
-    s = SafeStage(**stage.dict())
-    s.owner = SafeUser(**stage.owner.dict())
-    return json({"stage": loads(s.json())})
+    await invalidate_listings(stage.owner_id)
+    return json({"stage": safe_stage(stage)})
 
 
 class UpdateStageRequest(CreateStageRequest):
@@ -212,15 +210,16 @@ async def update_stage(req: Request, body: UpdateStageRequest, sid: str):
         return json({"message": "You don't have access to this stage"}, status=403)
     password_up = {}
     if body.use_password_in_body:
-        password_up = {
-            "password": hashpw(body.password.encode(), gensalt(12)).decode() if body.password is not None else None}
+        password_up = {"password": await hash_password(body.password) if body.password is not None else None}
     stage = await db.stages.update({
         "name": body.name or stage.name,
         "color": body.color,
         "private": body.private,
         **password_up
     }, {"id": sid}, include={"owner": True})
-    return json({"stage": loads(SafeStage(**stage.dict()).json())})
+    await access_index.update_stage(stage)
+    await invalidate_listings(stage.owner_id)
+    return json({"stage": safe_stage(stage)})
 
 
 @router.delete("/<sid:str>")
@@ -232,4 +231,7 @@ async def delete_stage(req: Request, sid: str):
     if stage.owner_id != req.ctx.user.id:
         return json({"message": "You don't have access to this stage"}, status=403)
     await db.stages.delete({"id": sid})
-    return json({"stage": loads(SafeStage(**stage.dict()).json())})
+    await access_index.remove_stage(sid)
+    chat_buffer.evict(sid)
+    await invalidate_listings(stage.owner_id)
+    return json({"stage": safe_stage(stage)})
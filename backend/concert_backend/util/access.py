@@ -0,0 +1,94 @@
+import os
+from dataclasses import dataclass, field
+from uuid import uuid4 as uuid
+
+from prisma.models import Stages
+
+from concert_backend.util.cache import TTLCache
+from concert_backend.util.db import db
+from concert_backend.util.kv import kv
+
+
+@dataclass(slots=True)
+class StageAccess:
+    id: str
+    owner_id: str
+    private: bool
+    invited: set[str] = field(default_factory=set)
+    # the version of the stage's access in the KV store when this was loaded
+    version: str | None = None
+
+    def allows(self, uid: str | None) -> bool:
+        """Whether the user `uid` (None if not logged in) can see the stage"""
+        return not self.private or (uid is not None and (uid == self.owner_id or uid in self.invited))
+
+
+class AccessIndex:
+    """Answers "can user U see stage S" from memory.
+
+    A stage's owner, privacy flag and invited users are loaded on first use and kept up to date by the
+    handlers that change them. With a shared KV store, every change also gives the stage a new version
+    there, and entries of an older version are reloaded, so access removed through one worker is removed
+    on all of them right away. Entries expire after `ttl` seconds.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.ttl = ttl
+        self._stages = TTLCache(maxsize, ttl)
+
+    async def get(self, sid: str) -> StageAccess | None:
+        # read before loading, so a change made while the stage is loaded isn't missed
+        version = await kv.get(f"stage_access:{sid}") if kv.shared else None
+        access: StageAccess | None = self._stages.get(sid)
+        if access is None or access.version != version:
+            stage = await db.stages.find_unique(where={"id": sid}, include={"invites": True})
+            if not stage:
+                self._stages.pop(sid)
+                return None
+            access = StageAccess(stage.id, stage.owner_id, stage.private,
+                                 {invite.user_id for invite in stage.invites or []}, version)
+            self._stages.set(sid, access)
+        return access
+
+    async def _changed(self, sid: str, access: StageAccess | None):
+        if not kv.shared:
+            return
+        version = str(uuid())
+        # an entry never outlives the ttl, so neither does a version anything can still compare against
+        await kv.set(f"stage_access:{sid}", version, self.ttl)
+        if access is not None:
+            access.version = version
+
+    async def can_view(self, uid: str | None, sid: str) -> bool:
+        access = await self.get(sid)
+        return access is not None and access.allows(uid)
+
+    async def update_stage(self, stage: Stages):
+        access: StageAccess | None = self._stages.get(stage.id, count=False)
+        if access is not None:
+            access.owner_id = stage.owner_id
+            access.private = stage.private
+        await self._changed(stage.id, access)
+
+    async def remove_stage(self, sid: str):
+        self._stages.pop(sid)
+        await self._changed(sid, None)
+
+    async def add_invites(self, sid: str, *uids: str):
+        access: StageAccess | None = self._stages.get(sid, count=False)
+        if access is not None:
+            access.invited.update(uids)
+        await self._changed(sid, access)
+
+    async def remove_invite(self, sid: str, uid: str):
+        access: StageAccess | None = self._stages.get(sid, count=False)
+        if access is not None:
+            access.invited.discard(uid)
+        await self._changed(sid, access)
+
+    @property
+    def stats(self):
+        return self._stages.stats
+
+
+access_index = AccessIndex(int(os.getenv("ACCESS_INDEX_SIZE", 4096)), float(os.getenv("ACCESS_INDEX_TTL", 60)))
@@ -1,9 +1,8 @@
 from functools import wraps
 
-from prisma.partials import SafeUser
 from sanic import json
 
-from .tokens import get_user_from_access_token
+from .tokens import get_session_from_access_token
 
 
 def get_token_from_header(auth_header: str):
@@ -23,12 +22,11 @@ def auth(required=True):
                 if required:
                     return json({"message": "Invalid token"}, status=401)
                 return await func(request, *args, **kwargs)
-            user = await get_user_from_access_token(token)
-            if not user and required:
+            session = await get_session_from_access_token(token)
+            if not session and required:
                 return json({"message": "Unauthorized"}, status=401)
-            if user:
-                request.ctx.user = user
-                request.ctx.safe_user = SafeUser(**user.dict())
+            if session:
+                request.ctx.user, request.ctx.safe_user = session
             return await func(request, *args, **kwargs)
 
         return wrapper
@@ -1,7 +1,33 @@
+import asyncio
 import os
 from abc import abstractmethod
 
-from httpx import AsyncClient
+from httpx import AsyncClient, Limits, Timeout, HTTPError
+
+from concert_backend.util.metrics import timed
+
+_http: AsyncClient | None = None
+
+
+def get_http() -> AsyncClient:
+    """The pooled HTTP client shared by all providers of this worker"""
+    global _http
+    if _http is None:
+        _http = AsyncClient(
+            http2=True,
+            timeout=Timeout(float(os.getenv("OAUTH_TIMEOUT", 10)), connect=5),
+            limits=Limits(max_connections=int(os.getenv("OAUTH_MAX_CONNECTIONS", 20)),
+                          max_keepalive_connections=int(os.getenv("OAUTH_MAX_CONNECTIONS", 20)),
+                          keepalive_expiry=60),
+        )
+    return _http
+
+
+async def close_http():
+    global _http
+    if _http is not None:
+        await _http.aclose()
+        _http = None
 
 
 class Provider:
@@ -38,65 +64,80 @@ class GitHub(Provider):
 
     @classmethod
     async def get_token(cls, code: str):
-        async with AsyncClient() as client:
-            response = await client.post(cls.token_url, json={
-                "client_id": cls.client_id,
-                "client_secret": cls.client_secret,
-                "code": code,
-                "redirect_urL": f"{os.getenv('SELF_URL')}/api/auth/github/callback"
-            }, headers={"Accept": "application/json"})
-            data = response.json()
-            if type(data) == dict and data.get("access_token"):
-                if type(data.get("scope")) == str and 'user:email' in data["scope"]:
-                    return {
-                        "access_token": data["access_token"],
-                        "refresh_token": data.get("refresh_token", None),
-                    }
-                return "Invalid scope, please try authenticating again"
-            else:
-                return data.get("error_description", data.get("error", data.get("message",
-                                                                                "An unknown error occurred while "
-                                                                                "fetching the token from GitHub")))
+        try:
+            async with timed("oauth", f"{cls.name}.get_token"):
+                response = await get_http().post(cls.token_url, json={
+                    "client_id": cls.client_id,
+                    "client_secret": cls.client_secret,
+                    "code": code,
+                    "redirect_urL": f"{os.getenv('SELF_URL')}/api/auth/github/callback"
+                }, headers={"Accept": "application/json"})
+        except HTTPError:
+            return "Could not reach GitHub, please try again"
+        data = response.json()
+        if type(data) == dict and data.get("access_token"):
+            if type(data.get("scope")) == str and 'user:email' in data["scope"]:
+                return {
+                    "access_token": data["access_token"],
+                    "refresh_token": data.get("refresh_token", None),
+                }
+            return "Invalid scope, please try authenticating again"
+        else:
+            return data.get("error_description", data.get("error", data.get("message",
+                                                                            "An unknown error occurred while "
+                                                                            "fetching the token from GitHub")))
 
     @classmethod
     async def get_user_info(cls, access_token: str, refresh_token: str | None):
-        async with AsyncClient() as client:
-            response = await client.get(f"{cls.api_url}/user", headers={"Authorization": f"token {access_token}"})
-            data = response.json()
-            if response.status_code != 200:
-                return data.get("error_description", data.get("error", data.get("message",
-                                                                                "An unknown error occurred while "
-                                                                                "fetching user data from GitHub")))
-            email_res = await client.get(f"{cls.api_url}/user/emails",
-                                         headers={"Authorization": f"token {access_token}"})
-            email_data = email_res.json()
-            if email_res.status_code != 200:
-                return data.get("error_description", data.get("error", data.get("message",
-                                                                                "An unknown error occurred while "
-                                                                                "fetching email data from GitHub")))
-            email = next((email for email in email_data if email.get("primary") and email.get("verified")), None)
-            if not email:
-                return "No verified primary email found"
-            return {
-                "provider_id": str(data.get("id")),
-                "username": data.get("login"),
-                "email": email.get("email"),
-                "avatar_url": data.get("avatar_url"),
-                "provider": "github"
-            }
+        http = get_http()
+        headers = {"Authorization": f"token {access_token}"}
+        user_task = asyncio.create_task(http.get(f"{cls.api_url}/user", headers=headers))
+        email_task = asyncio.create_task(http.get(f"{cls.api_url}/user/emails", headers=headers))
+        try:
+            async with timed("oauth", f"{cls.name}.get_user_info"):
+                response, email_res = await asyncio.gather(user_task, email_task)
+        except HTTPError:
+            return "Could not reach GitHub, please try again"
+        finally:
+            # when one request fails, the other one is not left running
+            user_task.cancel()
+            email_task.cancel()
+            await asyncio.gather(user_task, email_task, return_exceptions=True)
+        data = response.json()
+        if response.status_code != 200:
+            return data.get("error_description", data.get("error", data.get("message",
+                                                                            "An unknown error occurred while "
+                                                                            "fetching user data from GitHub")))
+        email_data = email_res.json()
+        if email_res.status_code != 200:
+            return email_data.get("error_description", email_data.get("error", email_data.get(
+                "message", "An unknown error occurred while fetching email data from GitHub")))
+        email = next((email for email in email_data if email.get("primary") and email.get("verified")), None)
+        if not email:
+            return "No verified primary email found"
+        return {
+            "provider_id": str(data.get("id")),
+            "username": data.get("login"),
+            "email": email.get("email"),
+            "avatar_url": data.get("avatar_url"),
+            "provider": "github"
+        }
 
     @classmethod
     async def revoke_token(cls, access_token: str, refresh_token: str | None):
-        async with AsyncClient() as client:
-            response = await client.post(f"{cls.api_url}/applications/{cls.client_id}/token",
-                                         headers={"Authorization": f"token {access_token}"},
-                                         json={"access_token": access_token})
-            data = response.json() or dict()
-            if response.status_code != 204:
-                return data.get("error_description", data.get("error", data.get("message",
-                                                                                "An unknown error occurred while "
-                                                                                "revoking the token from GitHub")))
-            return True
+        try:
+            async with timed("oauth", f"{cls.name}.revoke_token"):
+                response = await get_http().post(f"{cls.api_url}/applications/{cls.client_id}/token",
+                                                 headers={"Authorization": f"token {access_token}"},
+                                                 json={"access_token": access_token})
+        except HTTPError:
+            return "Could not reach GitHub, please try again"
+        data = response.json() or dict()
+        if response.status_code != 204:
+            return data.get("error_description", data.get("error", data.get("message",
+                                                                            "An unknown error occurred while "
+                                                                            "revoking the token from GitHub")))
+        return True
 
 
 providers = {
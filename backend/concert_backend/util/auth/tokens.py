@@ -1,19 +1,43 @@
 import datetime
 import os
+import time
+from uuid import uuid4 as uuid
 
 from jwt import encode, PyJWTError, decode
 from prisma.models import Users
+from prisma.partials import SafeUser
+from sanic.log import logger
 
+from concert_backend.util.cache import TTLCache
 from concert_backend.util.db import db
+from concert_backend.util.kv import kv
 
 JWT_SECRET = os.getenv("JWT_SECRET", "secret")
 JWT_EXPIRY = int(os.getenv("JWT_EXPIRY", 900))
+REFRESH_TOKEN_LIFETIME = datetime.timedelta(days=30)
+# "database" stores refresh tokens in Mongo. "stateless" issues signed, rotating tokens that are verified without
+# a database read. Tokens of both kinds are accepted whichever mode is set.
+REFRESH_TOKEN_MODE = os.getenv("REFRESH_TOKEN_MODE", "database")
+# a different key than access tokens by default, so neither kind of token is accepted as the other
+REFRESH_TOKEN_SECRET = os.getenv("REFRESH_TOKEN_SECRET") or f"{JWT_SECRET}:refresh"
+# seconds during which a rotated stateless refresh token still gets its successor back, so that two tabs
+# refreshing at the same time don't log each other out
+REFRESH_TOKEN_ROTATION_GRACE = float(os.getenv("REFRESH_TOKEN_ROTATION_GRACE", 30))
+
+# user id -> (user, safe user). Entries never outlive an access token, so a changed user is picked up
+# within JWT_EXPIRY seconds even on workers that did not see the change.
+user_cache = TTLCache(int(os.getenv("USER_CACHE_SIZE", 2048)),
+                      min(float(os.getenv("USER_CACHE_TTL", JWT_EXPIRY)), JWT_EXPIRY))
 
 
 def generate_access_token(user: Users):
+    return generate_access_token_for(user.id)
+
+
+def generate_access_token_for(user_id: str):
     return encode(
         {
-            "id": user.id,
+            "id": user_id,
             "exp": datetime.datetime.utcnow() + datetime.timedelta(seconds=JWT_EXPIRY),
         },
         JWT_SECRET,
@@ -21,29 +45,126 @@ def generate_access_token(user: Users):
     )
 
 
-async def get_user_from_access_token(token: str) -> Users | None:
+async def get_session_from_access_token(token: str) -> tuple[Users, SafeUser] | None:
     try:
         decoded = decode(token, JWT_SECRET, algorithms=["HS256"])
-        return await db.users.find_unique({"id": decoded["id"]}) or None
     except PyJWTError as e:
-        print(e)
+        logger.debug("Rejected access token: %s", e)
+        return None
+    # refresh tokens carry a `typ` and no `id`
+    user_id = decoded.get("id")
+    if "typ" in decoded or not isinstance(user_id, str):
+        return None
+    session = user_cache.get(user_id)
+    if session:
+        return session
+    user = await db.users.find_unique({"id": user_id})
+    if not user:
         return None
+    session = (user, SafeUser(**user.dict()))
+    user_cache.set(user.id, session)
+    return session
+
+
+def invalidate_user(user_id: str):
+    """Drops a user from the cache. Call this whenever a user record is changed."""
+    user_cache.pop(user_id)
+
+
+def is_stateless_refresh_token(refresh_token: str):
+    return refresh_token.count(".") == 2
+
+
+def generate_stateless_refresh_token(user_id: str):
+    return encode(
+        {
+            "sub": user_id,
+            "typ": "refresh",
+            "jti": str(uuid()),
+            "exp": datetime.datetime.utcnow() + REFRESH_TOKEN_LIFETIME,
+        },
+        REFRESH_TOKEN_SECRET,
+        algorithm="HS256",
+    )
+
+
+def verify_stateless_refresh_token(refresh_token: str) -> dict | None:
+    """Checks the signature and claims of a stateless refresh token, but not whether it was revoked"""
+    try:
+        claims = decode(refresh_token, REFRESH_TOKEN_SECRET, algorithms=["HS256"])
+    except PyJWTError:
+        return None
+    if claims.get("typ") != "refresh" or not claims.get("jti") or not claims.get("sub"):
+        return None
+    return claims
+
+
+async def decode_stateless_refresh_token(refresh_token: str) -> dict | None:
+    """Verifies a stateless refresh token and checks it against the revocation list"""
+    claims = verify_stateless_refresh_token(refresh_token)
+    if not claims or await kv.get(f"revoked_refresh_token:{claims['jti']}"):
+        return None
+    return claims
+
+
+async def revoke_stateless_refresh_token(claims: dict):
+    # revocations are only kept until the token would have expired anyway, which keeps the list small. They are
+    # only seen by every worker with a shared KV store, which main.py requires to run more than one.
+    await kv.set(f"revoked_refresh_token:{claims['jti']}", "1", claims["exp"] - time.time())
+
+
+async def rotate_stateless_refresh_token(refresh_token: str) -> str | None:
+    """Revokes a stateless refresh token and returns the one replacing it.
+
+    Within REFRESH_TOKEN_ROTATION_GRACE seconds of the rotation, the old token gets the same successor back
+    instead of being rejected, as long as the successor was not revoked itself.
+    """
+    claims = verify_stateless_refresh_token(refresh_token)
+    if not claims:
+        return None
+    successor = await kv.get(f"rotated_refresh_token:{claims['jti']}")
+    if successor:
+        return successor if await decode_stateless_refresh_token(successor) else None
+    if await kv.get(f"revoked_refresh_token:{claims['jti']}"):
+        return None
+    successor = generate_stateless_refresh_token(claims["sub"])
+    if REFRESH_TOKEN_ROTATION_GRACE > 0:
+        await kv.set(f"rotated_refresh_token:{claims['jti']}", successor, REFRESH_TOKEN_ROTATION_GRACE)
+    await revoke_stateless_refresh_token(claims)
+    return successor
 
 
 async def generate_refresh_token(user: Users):
+    if REFRESH_TOKEN_MODE == "stateless":
+        return generate_stateless_refresh_token(user.id)
     token = await db.refreshtokens.create({"user": {"connect": {"id": user.id}}})
     return token.token
 
 
-async def get_access_token_from_refresh_token(refresh_token: str):
+async def refresh_access_token(refresh_token: str) -> tuple[str, str] | None:
+    """Returns a new access token and the refresh token to use from now on.
+
+    Stateless refresh tokens are rotated: the one passed in is revoked and a new one is returned.
+    """
+    if is_stateless_refresh_token(refresh_token):
+        successor = await rotate_stateless_refresh_token(refresh_token)
+        if not successor:
+            return None
+        return generate_access_token_for(verify_stateless_refresh_token(successor)["sub"]), successor
+
     token = await db.refreshtokens.find_unique({"token": refresh_token}, {"user": True})
     if not token:
         return None
-    if token.created_at.replace(tzinfo=None) < (datetime.datetime.utcnow() - datetime.timedelta(days=30)).replace(
+    if token.created_at.replace(tzinfo=None) < (datetime.datetime.utcnow() - REFRESH_TOKEN_LIFETIME).replace(
             tzinfo=None):
         return None
-    return generate_access_token(token.user)
+    return generate_access_token(token.user), refresh_token
 
 
 async def revoke_refresh_token(refresh_token: str):
+    if is_stateless_refresh_token(refresh_token):
+        claims = await decode_stateless_refresh_token(refresh_token)
+        if claims:
+            await revoke_stateless_refresh_token(claims)
+        return
     await db.refreshtokens.delete({"token": refresh_token})
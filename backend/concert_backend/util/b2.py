@@ -1,12 +1,166 @@
+import asyncio
+import io
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from b2sdk.v2 import B2Api, InMemoryAccountInfo, FileVersion
+from b2sdk.http_constants import HEX_DIGITS_AT_END
+from b2sdk.v2 import B2Api, InMemoryAccountInfo, Bucket, StreamWithHash
 
+from concert_backend.util.metrics import timed
 
-def upload_file(file: bytes, filename: str, content_type: str) -> str:
-    info = InMemoryAccountInfo()
-    b2 = B2Api(info)
-    b2.authorize_account("production", os.getenv("B2_ID"), os.getenv("B2_KEY"))
-    bucket = b2.get_bucket_by_name(os.getenv("B2_BUCKET"))
-    res: FileVersion = bucket.upload_bytes(file, filename, content_type)
+B2_UPLOAD_WORKERS = int(os.getenv("B2_UPLOAD_WORKERS", 4))
+
+_executor: ThreadPoolExecutor | None = None
+_bucket: Bucket | None = None
+_lock = threading.Lock()
+
+
+def get_bucket() -> Bucket:
+    """Returns the bucket of a long-lived, authorized B2 client shared by the worker.
+
+    The account is only authorized once. b2sdk keeps the credentials in the account info and
+    reauthorizes on its own when the auth token expires. This call blocks, so run it off the event loop.
+    """
+    global _bucket
+    if _bucket is None:
+        with _lock:
+            if _bucket is None:
+                b2 = B2Api(InMemoryAccountInfo())
+                b2.authorize_account("production", os.getenv("B2_ID"), os.getenv("B2_KEY"))
+                _bucket = b2.get_bucket_by_name(os.getenv("B2_BUCKET"))
+    return _bucket
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(B2_UPLOAD_WORKERS, thread_name_prefix="b2-upload")
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+def get_file_url(bucket: Bucket, filename: str) -> str:
     return f"https://{os.getenv('B2_REGION')}.backblazeb2.com/file/{bucket.name}/{filename}"
+
+
+def _upload_bytes(file: bytes, filename: str, content_type: str) -> str:
+    bucket = get_bucket()
+    bucket.upload_bytes(file, filename, content_type)
+    return get_file_url(bucket, filename)
+
+
+async def upload_file(file: bytes, filename: str, content_type: str) -> str:
+    """Uploads `file` on the upload thread pool, so the event loop is never blocked"""
+    loop = asyncio.get_running_loop()
+    async with timed("b2", "upload_file"):
+        return await loop.run_in_executor(get_executor(), _upload_bytes, file, filename, content_type)
+
+
+class StreamPipe(io.RawIOBase):
+    """A read-only stream fed with chunks from the event loop and read by an upload thread.
+
+    At most `maxsize` chunks are buffered, so the memory used by an upload stays flat no matter how
+    large the body is. Feeding a chunk waits until the reader has room for it.
+    """
+
+    def __init__(self, maxsize=8):
+        super().__init__()
+        self._loop = asyncio.get_running_loop()
+        self._queue: asyncio.Queue[bytes | BaseException | None] = asyncio.Queue(maxsize)
+        self._reader_closed = asyncio.Event()
+        self._buffer = bytearray()
+        self._position = 0
+        self._eof = False
+        self._opened = False
+
+    # event loop side
+
+    async def feed(self, chunk: bytes | None):
+        """Passes `chunk` to the reader. `None` marks the end of the stream."""
+        if self._reader_closed.is_set():
+            raise BrokenPipeError("The upload stopped reading the stream")
+        put = asyncio.ensure_future(self._queue.put(chunk))
+        closed = asyncio.ensure_future(self._reader_closed.wait())
+        await asyncio.wait((put, closed), return_when=asyncio.FIRST_COMPLETED)
+        closed.cancel()
+        if not put.done():
+            put.cancel()
+            raise BrokenPipeError("The upload stopped reading the stream")
+
+    def abort(self, exc: BaseException):
+        """Makes the reader fail with `exc` instead of waiting for more data"""
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._queue.put_nowait(exc)
+
+    # upload thread side
+
+    def open_once(self):
+        """Opens the pipe for the upload. This only works once, as what was read is gone. `_upload_stream` makes sure
+        b2sdk reads it a single time. This was checked against b2sdk 1.18's RawSimulator; Bucket.upload opens its
+        source more than once and fails here."""
+        if self._opened:
+            raise ValueError("A piped stream can only be read once")
+        self._opened = True
+        return self
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1) -> bytes:
+        while (size < 0 or len(self._buffer) < size) and not self._eof:
+            chunk = asyncio.run_coroutine_threadsafe(self._queue.get(), self._loop).result()
+            if chunk is None:
+                self._eof = True
+            elif isinstance(chunk, BaseException):
+                raise chunk
+            else:
+                self._buffer += chunk
+        size = len(self._buffer) if size < 0 else min(size, len(self._buffer))
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._position += size
+        return data
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # uploaders rewind their input before every attempt, which is only possible before the first read
+        if offset == 0 and whence == io.SEEK_SET and self._position == 0:
+            return 0
+        raise io.UnsupportedOperation("A piped stream can not be rewound")
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._loop.call_soon_threadsafe(self._reader_closed.set)
+            except RuntimeError:
+                pass  # the loop is already closed
+        super().close()
+
+
+def _upload_stream(pipe: StreamPipe, length: int, filename: str, content_type: str) -> str:
+    bucket = get_bucket()
+    # Bucket.upload can't be used here: with b2sdk 1.18 it opens an UploadSourceStream once to compute the sha1
+    # and again to send it, and opens it again for every retry. A single upload with the sha1 appended to the body
+    # (what Bucket.upload does itself for small files of unknown sha1) reads the pipe exactly once, in order.
+    # Retries of the request rewind the stream, which fails once anything was read, so a failed upload is never
+    # sent again with part of the file missing.
+    stream = StreamWithHash(pipe.open_once(), stream_length=length)
+    bucket.api.session.upload_file(bucket.id_, filename, len(stream), content_type, HEX_DIGITS_AT_END, {}, stream)
+    return get_file_url(bucket, filename)
+
+
+async def upload_stream(pipe: StreamPipe, length: int, filename: str, content_type: str) -> str:
+    """Uploads `length` bytes fed into `pipe` while they are still arriving, without buffering the whole file"""
+    loop = asyncio.get_running_loop()
+    async with timed("b2", "upload_stream"):
+        return await loop.run_in_executor(get_executor(), _upload_stream, pipe, length, filename, content_type)
@@ -0,0 +1,45 @@
+import os
+from collections import deque
+
+from prisma.models import ChatMessages
+
+from concert_backend.util.cache import TTLCache
+
+CHAT_BUFFER_SIZE = int(os.getenv("CHAT_BUFFER_SIZE", 100))
+
+
+class ChatBuffer:
+    """Keeps the last `size` chat messages of the most recently active stages of this worker.
+
+    A stage is only buffered once its history was loaded from the database, so a buffer always holds the
+    newest messages of its stage. Messages sent through other workers are not seen here, which is why
+    buffers are dropped after `ttl` seconds and reloaded. Idle stages are evicted least recently used first.
+    """
+
+    def __init__(self, size: int, max_stages: int, ttl: float):
+        self.size = size
+        self._stages = TTLCache(max_stages, ttl)
+
+    def get(self, sid: str) -> list[ChatMessages] | None:
+        messages: deque | None = self._stages.get(sid)
+        return list(messages) if messages is not None else None
+
+    def load(self, sid: str, messages: list[ChatMessages]):
+        """Buffers the newest messages of a stage, oldest first"""
+        self._stages.set(sid, deque(messages, maxlen=self.size))
+
+    def append(self, sid: str, message: ChatMessages):
+        messages: deque | None = self._stages.get(sid, count=False)
+        if messages is not None:
+            messages.append(message)
+
+    def evict(self, sid: str):
+        self._stages.pop(sid)
+
+    @property
+    def stats(self):
+        return self._stages.stats
+
+
+chat_buffer = ChatBuffer(CHAT_BUFFER_SIZE, int(os.getenv("CHAT_BUFFER_STAGES", 1024)),
+                         float(os.getenv("CHAT_BUFFER_TTL", 5)))
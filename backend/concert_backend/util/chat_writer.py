@@ -0,0 +1,138 @@
+import asyncio
+import os
+from datetime import datetime, timezone
+from uuid import uuid4 as uuid
+
+from prisma.models import ChatMessages, Users
+from sanic.log import logger
+
+from concert_backend.util.db import db
+
+
+class ChatWriter:
+    """Creates chat messages, optionally persisting them write-behind.
+
+    When enabled, a message gets its id and timestamps right away so it can be broadcast, and is queued.
+    The queue is flushed to the database with `create_many` once `batch_size` messages are waiting or every
+    `interval` seconds, whichever comes first. If `max_pending` messages are waiting (e.g. the database is
+    down), new messages are written directly again so the queue can't grow without bound.
+    """
+
+    def __init__(self, enabled: bool, batch_size: int, interval: float, max_pending: int):
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending: list[ChatMessages] = []
+        # set when a write failed. `create_many` may have written part of the batch before failing, so the
+        # messages that are already in the database are left out when it is retried
+        self._retrying = False
+        self._wake: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def depth(self) -> int:
+        """Number of messages waiting to be written"""
+        return len(self._pending)
+
+    def pending(self, sid: str) -> list[ChatMessages]:
+        return [msg for msg in self._pending if msg.stage_id == sid]
+
+    def find_pending(self, mid: str) -> ChatMessages | None:
+        return next((msg for msg in self._pending if msg.id == mid), None)
+
+    @staticmethod
+    def _build(data: dict, user: Users) -> ChatMessages:
+        now = datetime.now(timezone.utc)
+        return ChatMessages(**{
+            "type": "TEXT",
+            "message_data": "",
+            **data,
+            "id": str(uuid()),
+            "user_id": user.id,
+            "created_at": now,
+            "updated_at": now,
+            "user": user,
+        })
+
+    def _queue(self, messages: list[ChatMessages]):
+        self._pending.extend(messages)
+        if len(self._pending) >= self.batch_size:
+            self._wake.set()
+
+    def _writes_directly(self, count: int) -> bool:
+        return not self.enabled or not self._task or len(self._pending) + count > self.max_pending
+
+    async def create(self, data: dict, user: Users) -> ChatMessages:
+        """Creates a message sent by `user`. `data` is what would be passed to `db.chatmessages.create`."""
+        if self._writes_directly(1):
+            return await db.chatmessages.create({**data, "user_id": user.id}, include={"user": True})
+        msg = self._build(data, user)
+        self._queue([msg])
+        return msg
+
+    async def create_many(self, messages: list[tuple[dict, Users]]) -> list[ChatMessages]:
+        """Creates several messages, given as (data, user) like `create`, with a single write"""
+        built = [self._build(data, user) for data, user in messages]
+        if not built:
+            return built
+        if self._writes_directly(len(built)):
+            await db.chatmessages.create_many([msg.dict(exclude={"user", "stage"}) for msg in built])
+        else:
+            self._queue(built)
+        return built
+
+    async def flush(self) -> int:
+        """Writes all waiting messages. Returns how many were written."""
+        written = 0
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            try:
+                unwritten = batch
+                if self._retrying:
+                    existing = await db.chatmessages.find_many(where={"id": {"in": [msg.id for msg in batch]}})
+                    existing_ids = {msg.id for msg in existing}
+                    unwritten = [msg for msg in batch if msg.id not in existing_ids]
+                if unwritten:
+                    written += await db.chatmessages.create_many(
+                        [msg.dict(exclude={"user", "stage"}) for msg in unwritten])
+            except BaseException:
+                # keep the batch for the next flush
+                self._pending[:0] = batch
+                self._retrying = True
+                raise
+        self._retrying = False
+        return written
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to write chat messages (%d waiting)", self.depth,
+                                 extra={"waiting": self.depth})
+
+    def start(self):
+        if self.enabled and not self._task:
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+chat_writer = ChatWriter(bool(int(os.getenv("CHAT_WRITE_BEHIND", 0))), int(os.getenv("CHAT_FLUSH_SIZE", 100)),
+                         float(os.getenv("CHAT_FLUSH_INTERVAL", 0.5)), int(os.getenv("CHAT_MAX_PENDING", 10000)))
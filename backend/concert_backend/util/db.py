@@ -1,3 +1,70 @@
+import os
+import time
+from urllib.parse import urlparse, parse_qsl, urlencode
+
 from prisma import Prisma
 
-db = Prisma()
+from concert_backend.util.metrics import track
+
+
+def get_database_url() -> str | None:
+    """DATABASE_URL with the connection pool of this worker sized to DB_POOL_SIZE, if it is set"""
+    url = os.getenv("DATABASE_URL")
+    pool_size = os.getenv("DB_POOL_SIZE")
+    if not url or not pool_size:
+        return url
+    parsed = urlparse(url)
+    query = dict(parse_qsl(parsed.query))
+    query.setdefault("maxPoolSize", pool_size)
+    return parsed._replace(query=urlencode(query)).geturl()
+
+
+class InstrumentedActions:
+    """Wraps the query methods of one model (`db.users`, ...) to track every query"""
+
+    def __init__(self, model: str, actions):
+        self._model = model
+        self._actions = actions
+
+    def __getattr__(self, name: str):
+        method = getattr(self._actions, name)
+        if not callable(method) or name.startswith("_"):
+            return method
+        operation = f"{self._model}.{name}"
+
+        async def query(*args, **kwargs):
+            start = time.perf_counter()
+            error = False
+            try:
+                return await method(*args, **kwargs)
+            except BaseException:
+                error = True
+                raise
+            finally:
+                track("prisma", operation, time.perf_counter() - start, error)
+
+        setattr(self, name, query)
+        return query
+
+
+class InstrumentedPrisma:
+    """A Prisma client whose model queries are tracked in the metrics. Everything else is passed through."""
+
+    def __init__(self, client: Prisma):
+        self.client = client
+        self._models: dict[str, InstrumentedActions] = {}
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.client, name)
+        # model accessors are the attributes with query methods
+        if hasattr(attr, "find_many"):
+            actions = self._models.get(name)
+            if actions is None or actions._actions is not attr:
+                actions = self._models[name] = InstrumentedActions(name, attr)
+            return actions
+        return attr
+
+
+# every worker process imports this module, so each one gets its own client and connection pool.
+# It is connected in the before_server_start listener.
+db = InstrumentedPrisma(Prisma(datasource={"url": get_database_url()}) if os.getenv("DB_POOL_SIZE") else Prisma())
@@ -0,0 +1,42 @@
+from dataclasses import is_dataclass, asdict
+from datetime import datetime
+from enum import Enum
+from typing import Any
+
+import orjson
+from prisma.models import Stages, Users
+from prisma.partials import SafeStage, SafeUser
+from pydantic import BaseModel
+
+SAFE_USER_FIELDS = tuple(SafeUser.__fields__)
+SAFE_STAGE_FIELDS = tuple(field for field in SafeStage.__fields__ if field != "owner")
+
+
+def _default(obj: Any):
+    # models are turned into shallow dicts, nested models and datetimes are encoded in the same pass
+    if isinstance(obj, BaseModel):
+        return dict(obj)
+    if is_dataclass(obj):
+        return asdict(obj)
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, Enum):
+        return obj.value
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj: Any, **_) -> bytes:
+    """Encodes `obj` straight to JSON bytes. Prisma models and partials can be passed as they are."""
+    return orjson.dumps(obj, default=_default)
+
+
+def safe_user(user: Users) -> dict:
+    """The fields of the SafeUser partial, without validating them again"""
+    return {field: getattr(user, field) for field in SAFE_USER_FIELDS}
+
+
+def safe_stage(stage: Stages) -> dict:
+    """The fields of the SafeStage partial with the owner as a SafeUser, without validating them again"""
+    data = {field: getattr(stage, field) for field in SAFE_STAGE_FIELDS}
+    data["owner"] = safe_user(stage.owner) if stage.owner else None
+    return data
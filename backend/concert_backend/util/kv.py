@@ -0,0 +1,120 @@
+import math
+import os
+import time
+from abc import ABC, abstractmethod
+
+
+class KVStore(ABC):
+    """A store for short-lived string values with native expiry"""
+
+    # whether every worker sees the same values
+    shared: bool
+
+    @abstractmethod
+    async def set(self, key: str, value: str, ttl: float):
+        """Stores `value` under `key` for `ttl` seconds"""
+
+    @abstractmethod
+    async def add(self, key: str, value: str, ttl: float) -> bool:
+        """Stores `value` under `key` for `ttl` seconds unless the key is set already. Returns whether it was
+        stored, so only one caller can take a key at a time."""
+
+    @abstractmethod
+    async def get(self, key: str) -> str | None:
+        pass
+
+    @abstractmethod
+    async def pop(self, key: str) -> str | None:
+        """Atomically gets and deletes `key`, so a value can only be consumed once"""
+
+    @abstractmethod
+    async def delete(self, key: str):
+        pass
+
+    async def close(self):
+        pass
+
+
+class MemoryStore(KVStore):
+    """A store local to this worker. Only suitable when a single worker serves every request of a flow."""
+
+    shared = False
+
+    def __init__(self):
+        self._data: dict[str, tuple[float, str]] = {}
+        self._next_sweep = 0.0
+
+    def _sweep(self, now: float):
+        if now >= self._next_sweep:
+            self._data = {k: v for k, v in self._data.items() if v[0] > now}
+            self._next_sweep = now + 60
+
+    async def set(self, key: str, value: str, ttl: float):
+        now = time.monotonic()
+        self._sweep(now)
+        self._data[key] = (now + ttl, value)
+
+    async def add(self, key: str, value: str, ttl: float) -> bool:
+        if await self.get(key) is not None:
+            return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def get(self, key: str) -> str | None:
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    async def pop(self, key: str) -> str | None:
+        entry = self._data.pop(key, None)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    async def delete(self, key: str):
+        self._data.pop(key, None)
+
+
+class RedisStore(KVStore):
+    """A store shared by every worker, backed by a Redis-compatible server"""
+
+    shared = True
+
+    def __init__(self, url: str, prefix="concert:"):
+        try:
+            from redis.asyncio import from_url
+        except ImportError:
+            raise RuntimeError("The redis package is required to use a redis:// KV_URL. "
+                               "Install it with `poetry install --extras redis`")
+        self._redis = from_url(url, decode_responses=True)
+        self._prefix = prefix
+
+    async def set(self, key: str, value: str, ttl: float):
+        await self._redis.set(self._prefix + key, value, ex=max(math.ceil(ttl), 1))
+
+    async def add(self, key: str, value: str, ttl: float) -> bool:
+        return bool(await self._redis.set(self._prefix + key, value, ex=max(math.ceil(ttl), 1), nx=True))
+
+    async def get(self, key: str) -> str | None:
+        return await self._redis.get(self._prefix + key)
+
+    async def pop(self, key: str) -> str | None:
+        return await self._redis.getdel(self._prefix + key)
+
+    async def delete(self, key: str):
+        await self._redis.delete(self._prefix + key)
+
+    async def close(self):
+        await self._redis.close()
+
+
+def create_store(url: str) -> KVStore:
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStore(url)
+    if url.startswith("memory://"):
+        return MemoryStore()
+    raise ValueError(f"Unsupported KV_URL: {url}")
+
+
+kv = create_store(os.getenv("KV_URL") or "memory://")
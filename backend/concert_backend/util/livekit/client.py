@@ -1,5 +1,90 @@
+import asyncio
 import os
+from base64 import b64encode
 
-from livekit import RoomServiceClient
+from google.protobuf.json_format import MessageToDict
+from httpx import AsyncClient, Limits, Timeout
+from livekit import ParticipantPermission
 
-client = RoomServiceClient(os.getenv("LIVEKIT_URL"), os.getenv("LIVEKIT_KEY"), os.getenv("LIVEKIT_SECRET"))
+from concert_backend.util.cache import TTLCache
+from concert_backend.util.metrics import timed
+from .token import create_server_token
+
+
+class AsyncRoomServiceClient:
+    """An asyncio-native client for LiveKit's RoomService twirp API.
+
+    All calls of a worker share one pooled HTTP connection to LiveKit and at most `max_concurrency`
+    of them are in flight at once. Call `connect` once the event loop runs and `close` before it stops.
+    """
+
+    def __init__(self, host: str, api_key: str, api_secret: str, timeout: float = 5, max_connections: int = 20,
+                 max_concurrency: int = 20):
+        self.host = (host or "").rstrip("/")
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_concurrency = max_concurrency
+        self._http: AsyncClient | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        # server tokens are valid for a minute, reuse them for most of it
+        self._tokens = TTLCache(1024, 45)
+
+    async def connect(self):
+        if self._http is None:
+            self._http = AsyncClient(
+                base_url=f"{self.host}/twirp/livekit.RoomService",
+                timeout=Timeout(self.timeout),
+                limits=Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+            self._semaphore = None
+
+    def _get_token(self, room: str) -> str:
+        token = self._tokens.get(room)
+        if not token:
+            token = create_server_token(room)
+            self._tokens.set(room, token)
+        return token
+
+    async def _request(self, method: str, room: str, body: dict) -> dict:
+        await self.connect()
+        async with timed("livekit", method), self._semaphore:
+            response = await self._http.post(f"/{method}", json=body,
+                                             headers={"Authorization": f"Bearer {self._get_token(room)}"})
+            response.raise_for_status()
+        return response.json()
+
+    async def send_data(self, room: str, data: bytes, kind: int, destination_sids: list[str]):
+        return await self._request("SendData", room, {
+            "room": room,
+            "data": b64encode(data).decode(),
+            "kind": int(kind),
+            "destination_sids": destination_sids,
+        })
+
+    async def update_participant(self, room: str, identity: str, metadata: str | None = None,
+                                 permission: ParticipantPermission | None = None):
+        body = {"room": room, "identity": identity}
+        if metadata is not None:
+            body["metadata"] = metadata
+        if permission is not None:
+            body["permission"] = MessageToDict(permission, preserving_proto_field_name=True,
+                                               including_default_value_fields=True)
+        return await self._request("UpdateParticipant", room, body)
+
+
+client = AsyncRoomServiceClient(
+    os.getenv("LIVEKIT_URL"),
+    os.getenv("LIVEKIT_KEY"),
+    os.getenv("LIVEKIT_SECRET"),
+    timeout=float(os.getenv("LIVEKIT_TIMEOUT", 5)),
+    max_connections=int(os.getenv("LIVEKIT_MAX_CONNECTIONS", 20)),
+    max_concurrency=int(os.getenv("LIVEKIT_MAX_CONCURRENCY", 20)),
+)
@@ -1,20 +1,21 @@
 import datetime
 import os
+import time
 from dataclasses import dataclass, asdict, fields
 from functools import wraps
 from hashlib import sha256
 from json import loads, dumps
-from random import choice
 from typing import TypedDict
 
 import jwt
 from prisma.models import Users, Stages
 from sanic import json
 
+from concert_backend.util.cache import TTLCache
 from .colors import colors
 
 
-@dataclass
+@dataclass(slots=True)
 class VideoGrant:
     # permission to create a room
     roomCreate: bool
@@ -62,7 +63,7 @@ class Metadata(TypedDict):
     color: str
 
 
-@dataclass
+@dataclass(slots=True)
 class ClaimGrants:
     name: str
     video: VideoGrant
@@ -70,9 +71,8 @@ class ClaimGrants:
     sha256: str
 
     def __init__(self, **kwargs):
-        names = set([f.name for f in fields(self)])
         for k, v in kwargs.items():
-            if k in names:
+            if k in CLAIM_GRANTS_FIELDS:
                 setattr(self, k, v)
 
     @property
@@ -80,13 +80,31 @@ class ClaimGrants:
         return loads(self.metadata)
 
 
+CLAIM_GRANTS_FIELDS = frozenset(f.name for f in fields(ClaimGrants))
+
+# sha256 of a token -> (subject, grants), until the token expires. Only verified tokens are cached.
+verified_tokens = TTLCache(int(os.getenv("LIVEKIT_VERIFIED_TOKEN_CACHE_SIZE", 8192)), 60 * 60)
+
+LIVEKIT_TOKEN_LIFETIME = 60 * 60
+# issued tokens are handed out again until less than this many seconds of validity are left
+LIVEKIT_TOKEN_MIN_VALIDITY = int(os.getenv("LIVEKIT_TOKEN_MIN_VALIDITY", 10 * 60))
+# (user id, stage id, can speak) -> token
+issued_tokens = TTLCache(int(os.getenv("LIVEKIT_ISSUED_TOKEN_CACHE_SIZE", 8192)),
+                         LIVEKIT_TOKEN_LIFETIME - LIVEKIT_TOKEN_MIN_VALIDITY)
+
+
+def get_color(user: Users) -> str:
+    """A colour for the user, that stays the same across tokens"""
+    return colors[int.from_bytes(sha256(user.id.encode()).digest()[:4], "big") % len(colors)]
+
+
 def get_metadata(user: Users) -> str:
     return dumps({
         "username": user.username,
         "avatar_url": user.avatar_url,
         "id": user.id,
         "joined_at": datetime.datetime.utcnow().isoformat(),
-        "color": choice(colors)
+        "color": get_color(user)
     })
 
 
@@ -117,13 +135,24 @@ def create_livekit_token(user: Users, stage: Stages, can_speak: bool = False):
         "sub": user.id,
         "iss": os.getenv("LIVEKIT_KEY"),
         "jwtid": user.id,
-        "exp": datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        "exp": datetime.datetime.utcnow() + datetime.timedelta(seconds=LIVEKIT_TOKEN_LIFETIME)
     }
 
     token = jwt.encode(payload, os.getenv("LIVEKIT_SECRET"), algorithm="HS256")
     return token
 
 
+def get_livekit_token(user: Users, stage: Stages, can_speak: bool = False):
+    """Like `create_livekit_token`, but hands out the token already issued for the same user, stage and speaker
+    flag while it is valid for long enough. Reconnects and refreshes therefore get the same token."""
+    key = (user.id, stage.id, can_speak)
+    token = issued_tokens.get(key)
+    if not token:
+        token = create_livekit_token(user, stage, can_speak)
+        issued_tokens.set(key, token)
+    return token
+
+
 def create_server_token(stage_id: str):
     """Creates a server token with admin access"""
     grants = ClaimGrants(
@@ -166,6 +195,23 @@ def validate_token(token: str):
         return None
 
 
+def verify_token(token: str) -> tuple[str, ClaimGrants] | None:
+    """Verifies a LiveKit token and parses its grants. Tokens that were verified before are looked up instead."""
+    key = sha256(token.encode()).digest()
+    verified = verified_tokens.get(key)
+    if verified:
+        return verified
+    payload = validate_token(token)
+    if not payload or "exp" not in payload:
+        return None
+    try:
+        verified = (payload.get("sub"), ClaimGrants(**payload))
+    except TypeError:
+        return None
+    verified_tokens.set(key, verified, ttl=payload["exp"] - time.time())
+    return verified
+
+
 def livekit(required=True):
     def decorator(func):
         @wraps(func)
@@ -177,17 +223,14 @@ def livekit(required=True):
                 if required:
                     return json({"message": "Invalid livekit token"}, status=401)
                 return await func(request, *args, **kwargs)
-            payload = validate_token(token)
-            if not payload and required:
+            verified = verify_token(token)
+            if not verified and required:
                 return json({"message": "Not in stage"}, status=401)
-            if payload:
-                if request.ctx.user.id != payload['sub']:
+            if verified:
+                sub, grants = verified
+                if request.ctx.user.id != sub:
                     return json({"error": "Unauthorized"}, 401)
-                try:
-                    grants = ClaimGrants(**payload)
-                    request.ctx.grants = grants
-                except TypeError:
-                    return json({"error": "Invalid livekit token"}, 401)
+                request.ctx.grants = grants
             return await func(request, *args, **kwargs)
 
         return wrapper
@@ -0,0 +1,30 @@
+import json
+import logging
+from datetime import datetime, timezone
+
+# attributes every log record has, anything else was passed through `extra`
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as one JSON object per line, with the fields passed through `extra` included"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "pid": record.process,
+            "message": record.getMessage(),
+            **{key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS},
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def use_json_logs(*loggers: str):
+    formatter = JSONFormatter()
+    for name in loggers:
+        for handler in logging.getLogger(name).handlers:
+            handler.setFormatter(formatter)
@@ -0,0 +1,319 @@
+import asyncio
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from bisect import bisect_left
+from contextlib import asynccontextmanager
+from typing import Any
+
+from sanic import Sanic, Request, HTTPResponse, text
+from sanic.log import logger
+from sanic.models.server_types import ConnInfo
+
+from concert_backend.util import tracing
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# seconds between writes of this worker's metrics for the other workers to read
+METRICS_WRITE_INTERVAL = float(os.getenv("METRICS_WRITE_INTERVAL", 5))
+# if set, /metrics requires it as a bearer token
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# the only files of METRICS_DIR that are read or removed, so it can be shared with other files:
+# <pid>.json snapshots, and the <pid>.<random>.tmp files they are written to
+SNAPSHOT_FILE = re.compile(r"(\d+)\.json")
+SNAPSHOT_TEMP_FILE = re.compile(r"\d+\.\w+\.tmp")
+
+metrics: dict[str, "Metric"] = {}
+
+
+class Metric:
+    type: str
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values: dict[tuple[str, ...], Any] = {}
+        metrics[name] = self
+
+    def _key(self, labels: dict[str, Any]) -> tuple[str, ...]:
+        return tuple(str(labels[label]) for label in self.labels)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value: float, **labels):
+        """Sets the total, for counts that are kept elsewhere and copied in by a collector"""
+        self.values[self._key(labels)] = value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        # a count per bucket (the last one is +Inf), then the sum of all values
+        values = self.values.get(key)
+        if values is None:
+            values = self.values[key] = [0] * (len(self.buckets) + 2)
+        values[bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+
+http_requests_in_flight = Gauge("concert_http_requests_in_flight", "Requests being handled")
+http_request_duration = Histogram("concert_http_request_duration_seconds", "Time taken to handle requests",
+                                  ("method", "route", "status"))
+external_calls = Counter("concert_external_calls_total", "Calls made to other services",
+                         ("service", "operation", "result"))
+external_call_duration = Histogram("concert_external_call_duration_seconds", "Time taken by calls to other services",
+                                   ("service", "operation"))
+cache_entries = Gauge("concert_cache_entries", "Entries in the in-process caches", ("cache",))
+cache_lookups = Counter("concert_cache_lookups_total", "Lookups in the in-process caches", ("cache", "result"))
+
+# name -> cache, whose `stats` ({"size", "hits", "misses"}) are copied into the metrics above for every snapshot
+caches: dict[str, Any] = {}
+
+
+def watch_cache(name: str, cache: Any):
+    caches[name] = cache
+
+
+def collect():
+    for name, cache in caches.items():
+        stats = cache.stats
+        cache_entries.set(stats["size"], cache=name)
+        cache_lookups.set(stats["hits"], cache=name, result="hit")
+        cache_lookups.set(stats["misses"], cache=name, result="miss")
+
+
+def track(service: str, operation: str, seconds: float, error=False):
+    """Records a call to a service (prisma, livekit, b2 or oauth), in the metrics and the trace of the request"""
+    external_calls.inc(service=service, operation=operation, result="error" if error else "ok")
+    external_call_duration.observe(seconds, service=service, operation=operation)
+    tracing.record(service, operation, seconds)
+
+
+@asynccontextmanager
+async def timed(service: str, operation: str):
+    """Tracks the call made inside the block"""
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        track(service, operation, time.perf_counter() - start, error)
+
+
+# Aggregation across workers. Every worker writes its metrics to METRICS_DIR/<pid>.json, /metrics sums them up.
+
+def snapshot() -> dict:
+    collect()
+    return {name: {
+        "type": metric.type,
+        "description": metric.description,
+        "labels": metric.labels,
+        "buckets": getattr(metric, "buckets", None),
+        "values": [[list(key), value] for key, value in metric.values.items()],
+    } for name, metric in metrics.items()}
+
+
+def write_snapshot(directory: str):
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    with tempfile.NamedTemporaryFile("w", dir=directory, prefix=f"{os.getpid()}.", suffix=".tmp", delete=False) as f:
+        json.dump(snapshot(), f)
+    os.replace(f.name, path)
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_snapshots(directory: str) -> dict:
+    """Sums up the metrics of every worker. Gauges of workers that are gone are left out, their counters are kept
+    so totals don't go down when a worker restarts."""
+    merged: dict[str, dict] = {}
+    for filename in os.listdir(directory):
+        match = SNAPSHOT_FILE.fullmatch(filename)
+        if not match:
+            continue
+        pid = int(match.group(1))
+        try:
+            with open(os.path.join(directory, filename)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, metric in data.items():
+            if metric["type"] == "gauge" and not _is_alive(pid):
+                continue
+            entry = merged.setdefault(name, {**metric, "values": {}})
+            for key, value in metric["values"]:
+                key = tuple(key)
+                current = entry["values"].get(key)
+                if current is None:
+                    entry["values"][key] = value
+                elif isinstance(value, list):
+                    entry["values"][key] = [a + b for a, b in zip(current, value)]
+                else:
+                    entry["values"][key] = current + value
+    return merged
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def render(merged: dict) -> str:
+    """Formats metrics in the Prometheus text format"""
+    lines = []
+    for name, metric in sorted(merged.items()):
+        lines.append(f"# HELP {name} {metric['description']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for key, value in sorted(metric["values"].items()):
+            if metric["type"] != "histogram":
+                lines.append(f"{name}{_format_labels(metric['labels'], key)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip([*metric["buckets"], "+Inf"], value[:-1]):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{name}_bucket{_format_labels(metric['labels'], key, le)} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(metric['labels'], key)} {value[-1]}")
+            lines.append(f"{name}_count{_format_labels(metric['labels'], key)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def setup(app: Sanic):
+    """Records request metrics on `app` and serves every worker's metrics on /metrics"""
+    writer: asyncio.Task | None = None
+    created_dir: str | None = None
+
+    @app.listener("main_process_start")
+    async def prepare_metrics_dir(app, loop):  # noqa
+        nonlocal created_dir
+        # workers are started after this, and get the directory through their environment
+        directory = os.getenv("METRICS_DIR")
+        if not directory:
+            created_dir = os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="concert-metrics-")
+            return
+        os.makedirs(directory, exist_ok=True)
+        for filename in os.listdir(directory):
+            if SNAPSHOT_FILE.fullmatch(filename) or SNAPSHOT_TEMP_FILE.fullmatch(filename):
+                os.remove(os.path.join(directory, filename))
+
+    @app.listener("main_process_stop")
+    async def remove_metrics_dir(app, loop):  # noqa
+        if created_dir:
+            shutil.rmtree(created_dir, ignore_errors=True)
+
+    async def write_periodically(directory: str):
+        while True:
+            await asyncio.sleep(METRICS_WRITE_INTERVAL)
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, write_snapshot, directory)
+            except OSError as e:
+                logger.warning("Failed to write metrics: %s", e)
+
+    @app.listener("after_server_start")
+    async def start_metrics_writer(app, loop):  # noqa
+        nonlocal writer
+        directory = os.getenv("METRICS_DIR")
+        if directory:
+            writer = asyncio.create_task(write_periodically(directory))
+
+    @app.listener("before_server_stop")
+    async def stop_metrics_writer(app, loop):  # noqa
+        nonlocal writer
+        if writer is not None:
+            writer.cancel()
+            writer = None
+            write_snapshot(os.getenv("METRICS_DIR"))
+
+    # A request is counted as in flight until its response goes through the middleware. Handlers that are cancelled
+    # or never respond (websockets) skip it, but they always end their connection, which then takes them out.
+
+    def end_in_flight(ctx):
+        if getattr(ctx, "metrics_in_flight", False):
+            ctx.metrics_in_flight = False
+            http_requests_in_flight.dec()
+
+    @app.on_request
+    async def start_request_metrics(request: Request):
+        # Sanic runs the request middleware again for the error response of a failed request
+        if hasattr(request.ctx, "metrics_start"):
+            return
+        request.ctx.metrics_start = time.perf_counter()
+        http_requests_in_flight.inc()
+        (request.conn_info or request).ctx.metrics_in_flight = True
+
+    @app.signal("http.lifecycle.complete")
+    async def end_connection_metrics(conn_info: ConnInfo):
+        end_in_flight(conn_info.ctx)
+
+    @app.on_response
+    async def record_request_metrics(request: Request, response: HTTPResponse):
+        start = getattr(request.ctx, "metrics_start", None)
+        if start is None:
+            return
+        del request.ctx.metrics_start
+        end_in_flight((request.conn_info or request).ctx)
+        route = f"/{request.route.path}" if request.route else "unmatched"
+        http_request_duration.observe(time.perf_counter() - start, method=request.method, route=route,
+                                      status=response.status)
+
+    @app.get("/metrics")
+    async def get_metrics(req: Request):
+        if METRICS_TOKEN and req.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+            return text("Unauthorized", status=401)
+        directory = os.getenv("METRICS_DIR")
+        if not directory:
+            merged = read_local()
+        else:
+            await asyncio.get_running_loop().run_in_executor(None, write_snapshot, directory)
+            merged = await asyncio.get_running_loop().run_in_executor(None, read_snapshots, directory)
+        return text(render(merged), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def read_local() -> dict:
+    return {name: {**metric, "values": {tuple(key): value for key, value in metric["values"]}}
+            for name, metric in snapshot().items()}
@@ -0,0 +1,97 @@
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from dataclasses import dataclass
+from datetime import datetime
+from json import loads, dumps
+from typing import Any
+
+from pydantic import BaseModel
+
+# sort key -> whether it is a date. Every key is backed by an index on Stages in schema.prisma
+SORTABLE_FIELDS = {"created_at": True, "updated_at": True, "name": False}
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 100
+
+
+class InvalidPage(ValueError):
+    pass
+
+
+@dataclass
+class Page:
+    """A page of a listing, keyset-paginated on (sort, id).
+
+    The position is carried by an opaque cursor, so fetching a page costs the same however deep it is.
+    `offset` is only kept for clients that don't send cursors yet.
+    """
+
+    limit: int
+    sort: str
+    sort_order: str
+    cursor: tuple[Any, str] | None = None
+    offset: int = 0
+
+    @classmethod
+    def from_args(cls, args) -> "Page":
+        try:
+            limit = int(args.get("limit") or DEFAULT_PAGE_SIZE)
+            offset = int(args.get("offset") or 0)
+        except ValueError:
+            raise InvalidPage("limit and offset must be numbers")
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            raise InvalidPage(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+        sort = args.get("sort") or "created_at"
+        if sort not in SORTABLE_FIELDS:
+            raise InvalidPage(f"sort must be one of {', '.join(SORTABLE_FIELDS)}")
+        sort_order = (args.get("sort_order") or "").lower()
+        if sort_order not in ("asc", "desc"):
+            sort_order = "desc"
+        page = cls(limit, sort, sort_order, offset=max(offset, 0))
+        if args.get("cursor"):
+            page.cursor = page.decode_cursor(args.get("cursor"))
+            page.offset = 0
+        return page
+
+    def cache_key(self) -> tuple:
+        """Identifies the page, whichever way its query parameters were spelled"""
+        return self.limit, self.sort, self.sort_order, self.cursor, self.offset
+
+    def decode_cursor(self, cursor: str) -> tuple[Any, str]:
+        try:
+            sort, sort_order, value, id_ = loads(urlsafe_b64decode(cursor.encode() + b"=" * (-len(cursor) % 4)))
+            # the values end up in the query, so anything but the types the sort field has is rejected here.
+            # Every sortable field is a non-null string or date, dates being in ISO format.
+            if not all(isinstance(part, str) for part in (sort, sort_order, value, id_)):
+                raise InvalidPage("Invalid cursor")
+            if SORTABLE_FIELDS[self.sort]:
+                value = datetime.fromisoformat(value)
+        except (ValueError, TypeError, KeyError):
+            raise InvalidPage("Invalid cursor")
+        if (sort, sort_order) != (self.sort, self.sort_order):
+            raise InvalidPage("The cursor was created for a different sort")
+        return value, id_
+
+    def encode_cursor(self, row: BaseModel) -> str:
+        value = getattr(row, self.sort)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        return urlsafe_b64encode(dumps([self.sort, self.sort_order, value, row.id]).encode()).rstrip(b"=").decode()
+
+    def query(self, where: dict) -> dict:
+        """Keyword arguments for `find_many` fetching this page, plus one row to know if there is a next page"""
+        kwargs = {
+            "take": self.limit + 1,
+            "skip": self.offset,
+            "order": [{self.sort: self.sort_order}, {"id": self.sort_order}],
+        }
+        if self.cursor:
+            value, id_ = self.cursor
+            op = "lt" if self.sort_order == "desc" else "gt"
+            where = {"AND": [where, {"OR": [{self.sort: {op: value}}, {self.sort: value, "id": {op: id_}}]}]}
+        return {"where": where, **kwargs}
+
+    def split(self, rows: list) -> tuple[list, str | None]:
+        """Splits the rows fetched with `query` into this page and the cursor of the next one"""
+        if len(rows) <= self.limit:
+            return rows, None
+        rows = rows[:self.limit]
+        return rows, self.encode_cursor(rows[-1])
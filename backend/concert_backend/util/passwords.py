@@ -0,0 +1,61 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from bcrypt import hashpw, gensalt, checkpw
+
+# bcrypt releases the GIL while hashing, so threads keep the event loop free and hash in parallel. A process pool
+# is not an option: Sanic starts its workers as daemonic processes, which can't have children.
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", 2))
+# hashes that may wait for the pool at once before new ones are rejected
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", 16))
+
+_executor: ThreadPoolExecutor | None = None
+_pending = 0
+
+
+class PoolFull(Exception):
+    pass
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(PASSWORD_WORKERS, thread_name_prefix="passwords")
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+def _hash_password(password: str) -> str:
+    return hashpw(password.encode(), gensalt(12)).decode()
+
+
+def _check_password(password: str, hashed: str) -> bool:
+    return checkpw(password.encode(), hashed.encode())
+
+
+async def _run(func, *args):
+    global _pending
+    if _pending >= PASSWORD_QUEUE_LIMIT:
+        raise PoolFull()
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(get_executor(), func, *args)
+    finally:
+        _pending -= 1
+
+
+async def hash_password(password: str) -> str:
+    """Hashes `password` with bcrypt on the password threads. Raises PoolFull if too many hashes are waiting."""
+    return await _run(_hash_password, password)
+
+
+async def check_password(password: str, hashed: str) -> bool:
+    """Checks `password` against a bcrypt hash on the password threads. Raises PoolFull if too many are waiting."""
+    return await _run(_check_password, password, hashed)
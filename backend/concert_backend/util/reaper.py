@@ -0,0 +1,74 @@
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+
+from sanic.log import logger
+
+from concert_backend.util.auth.tokens import REFRESH_TOKEN_LIFETIME
+from concert_backend.util.db import db
+from concert_backend.util.kv import kv
+
+# model actions, primary key, lifetime. OAuth states and codes are kept in the KV store now, only rows written
+# before that are left to clean up.
+EXPIRING_MODELS = (
+    ("oauthstates", "state", timedelta(minutes=15)),
+    ("oauthcodes", "code", timedelta(minutes=5)),
+    ("refreshtokens", "token", REFRESH_TOKEN_LIFETIME),
+)
+
+
+class Reaper:
+    """Periodically deletes expired OAuth states, codes and refresh tokens in batches.
+
+    Every worker runs one, but only the one that takes the round's lock in the KV store reaps.
+    """
+
+    def __init__(self, interval: float, batch_size: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task: asyncio.Task | None = None
+
+    async def reap(self) -> dict[str, int]:
+        """Deletes every expired row. Returns how many rows were removed per model."""
+        removed = {}
+        now = datetime.now(timezone.utc)
+        for name, key, lifetime in EXPIRING_MODELS:
+            actions = getattr(db, name)
+            removed[name] = 0
+            while True:
+                rows = await actions.find_many(where={"created_at": {"lt": now - lifetime}}, take=self.batch_size)
+                if not rows:
+                    break
+                removed[name] += await actions.delete_many(where={key: {"in": [getattr(row, key) for row in rows]}})
+                if len(rows) < self.batch_size:
+                    break
+        return removed
+
+    async def _run(self):
+        while True:
+            try:
+                # the lock runs out a bit before the next round, so whichever worker gets there first takes it again
+                if await kv.add("reaper_lock", str(os.getpid()), self.interval * 0.9):
+                    removed = await self.reap()
+                    logger.info("Reaped expired rows: %s",
+                                ", ".join(f"{name}={count}" for name, count in removed.items()),
+                                extra={"removed": removed})
+            except Exception:
+                logger.exception("Failed to reap expired rows")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.interval > 0 and not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+reaper = Reaper(float(os.getenv("REAPER_INTERVAL", 60 * 60)), int(os.getenv("REAPER_BATCH_SIZE", 500)))
@@ -0,0 +1,125 @@
+import os
+import time
+from collections import OrderedDict
+from uuid import uuid4 as uuid
+from dataclasses import dataclass
+from functools import wraps
+from typing import Callable, Hashable
+
+from sanic import HTTPResponse, Request
+
+from concert_backend.util.kv import kv
+
+
+@dataclass
+class CachedResponse:
+    expires: float
+    tag: str
+    body: bytes
+    status: int
+    headers: dict[str, str]
+    content_type: str
+
+
+class ResponseCache:
+    """An in-process cache of encoded responses, bounded by entry lifetime and total body size.
+
+    Entries are tagged, so that every cached page of a listing can be dropped at once when it changes.
+    Other workers drop theirs through `invalidate`.
+    """
+
+    def __init__(self, ttl: float, max_bytes: int):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, CachedResponse] = OrderedDict()
+
+    def _drop(self, key: tuple):
+        entry = self._entries.pop(key)
+        self.size -= len(entry.body)
+
+    def get(self, key: tuple) -> CachedResponse | None:
+        entry = self._entries.get(key)
+        if entry is None or entry.expires <= time.monotonic():
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def set(self, key: tuple, tag: str, res: HTTPResponse):
+        if len(res.body) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = CachedResponse(time.monotonic() + self.ttl, tag, res.body, res.status,
+                                            dict(res.headers), res.content_type)
+        self.size += len(res.body)
+        while self.size > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+
+    def invalidate(self, *tags: str):
+        for key in [key for key, entry in self._entries.items() if entry.tag in tags]:
+            self._drop(key)
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+response_cache = ResponseCache(float(os.getenv("RESPONSE_CACHE_TTL", 30)),
+                               int(os.getenv("RESPONSE_CACHE_SIZE", 16 * 1024 * 1024)))
+
+
+async def get_generation(tag: str) -> str | None:
+    """The generation of a tag, which is part of the key of its entries. With a shared KV store, `invalidate`
+    changes it on every worker, so their entries stop matching right away."""
+    return await kv.get(f"response_cache:{tag}") if kv.shared else None
+
+
+async def invalidate(*tags: str):
+    """Drops the entries of `tags` on this worker and, with a shared KV store, on all the others"""
+    response_cache.invalidate(*tags)
+    if kv.shared:
+        # entries don't outlive the ttl, so neither does a generation anything can still match
+        for tag in tags:
+            await kv.set(f"response_cache:{tag}", str(uuid()), response_cache.ttl)
+
+
+def cached(tag: Callable[..., str], key: Callable[[Request], Hashable]):
+    """Caches successful responses of an anonymous endpoint.
+
+    Responses are keyed by the path, `key(request)` and the generation of their tag. `key` should normalize the
+    query parameters the endpoint reads so that equivalent requests share an entry. Requests it raises ValueError
+    for are not cached. `tag` is called with the route parameters and names the group the response is
+    invalidated with.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(request: Request, *a, **kwargs):
+            try:
+                page_key = key(request)
+            except ValueError:
+                return await func(request, *a, **kwargs)
+            group = tag(**kwargs)
+            cache_key = (request.path, await get_generation(group), page_key)
+            entry = response_cache.get(cache_key)
+            if entry:
+                return HTTPResponse(entry.body, entry.status, entry.headers, entry.content_type)
+            res = await func(request, *a, **kwargs)
+            if res.status == 200:
+                response_cache.set(cache_key, group, res)
+            return res
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,125 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import pathlib
+from dataclasses import dataclass
+
+import brotli
+from sanic import HTTPResponse, Request
+from sanic.log import logger
+
+# SvelteKit puts content-hashed files here, so they never change under the same URL
+IMMUTABLE_PREFIX = "_app/immutable/"
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# everything else (index.html included) has to be revalidated, which is a 304 when nothing changed
+REVALIDATE_CACHE_CONTROL = "no-cache"
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "application/xml", "image/svg+xml",
+                      "application/manifest+json")
+# smaller files don't get smaller by compressing them
+MIN_COMPRESS_SIZE = 1024
+
+
+@dataclass(slots=True)
+class StaticAsset:
+    body: bytes
+    content_type: str
+    etag: str
+    cache_control: str
+    # encoding (br, gzip) -> body, best first
+    encoded: dict[str, bytes]
+
+
+def _is_compressible(content_type: str) -> bool:
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def _accepted_encodings(header: str) -> set[str]:
+    accepted = set()
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    """Whether an If-None-Match header lists `etag` (compared weakly, as RFC 9110 asks for this header)"""
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class StaticFiles:
+    """The built frontend, read into memory once with its compressed variants.
+
+    Files precompressed by the build (`file.js.gz`, `file.js.br`) are used as they are, the other
+    compressible files are compressed while loading, so serving a file costs no disk reads and no compression.
+    """
+
+    def __init__(self, root: str | os.PathLike):
+        self.root = pathlib.Path(root)
+        self.assets: dict[str, StaticAsset] = {}
+
+    def _read_encoded(self, path: pathlib.Path, body: bytes) -> dict[str, bytes]:
+        encoded = {}
+        br_path, gz_path = path.with_name(path.name + ".br"), path.with_name(path.name + ".gz")
+        encoded["br"] = br_path.read_bytes() if br_path.is_file() else brotli.compress(body, quality=11)
+        encoded["gzip"] = gz_path.read_bytes() if gz_path.is_file() else gzip.compress(body, 9, mtime=0)
+        # only keep variants that are worth sending
+        return {encoding: data for encoding, data in encoded.items() if len(data) < len(body)}
+
+    def load(self):
+        self.assets.clear()
+        for path in sorted(self.root.rglob("*")):
+            if not path.is_file() or path.suffix in (".gz", ".br") and path.with_suffix("").is_file():
+                continue
+            name = path.relative_to(self.root).as_posix()
+            body = path.read_bytes()
+            content_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+            if content_type.startswith("text/"):
+                content_type += "; charset=utf-8"
+            encoded = self._read_encoded(path, body) \
+                if len(body) >= MIN_COMPRESS_SIZE and _is_compressible(content_type) else {}
+            self.assets[name] = StaticAsset(
+                body, content_type, hashlib.blake2b(body, digest_size=12).hexdigest(),
+                IMMUTABLE_CACHE_CONTROL if name.startswith(IMMUTABLE_PREFIX) else REVALIDATE_CACHE_CONTROL,
+                encoded
+            )
+        logger.info("Loaded %d static files from %s", len(self.assets), self.root,
+                    extra={"files": len(self.assets), "bytes": sum(len(asset.body) for asset in self.assets.values())})
+
+    def get(self, path: str) -> StaticAsset | None:
+        path = path.strip("/")
+        return self.assets.get(path) or self.assets.get(f"{path}/index.html" if path else "index.html")
+
+    def response(self, request: Request, asset: StaticAsset) -> HTTPResponse:
+        """Responds with the best encoding of `asset` the client accepts, or 304 if it has it already"""
+        encoding, body = None, asset.body
+        if asset.encoded:
+            accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+            for name, data in asset.encoded.items():
+                if name in accepted:
+                    encoding, body = name, data
+                    break
+        # every encoding is a different representation, so it gets its own strong ETag
+        etag = f'"{asset.etag}-{encoding}"' if encoding else f'"{asset.etag}"'
+        headers = {"etag": etag, "cache-control": asset.cache_control}
+        if asset.encoded:
+            headers["vary"] = "accept-encoding"
+
+        # a 304 keeps the etag and vary of the representation the client would have gotten
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and _etag_matches(if_none_match, etag):
+            return HTTPResponse(status=304, headers=headers)
+        if encoding:
+            headers["content-encoding"] = encoding
+        return HTTPResponse(body, headers=headers, content_type=asset.content_type)
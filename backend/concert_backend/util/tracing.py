@@ -0,0 +1,80 @@
+import os
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+from sanic import Sanic, Request, HTTPResponse
+from sanic.log import logger
+
+# requests with this header get a Server-Timing header breaking down the calls they made
+TRACE_HEADER = os.getenv("TRACE_HEADER", "x-debug-trace")
+# requests making more queries than this are logged. 0 turns it off
+TRACE_QUERY_THRESHOLD = int(os.getenv("TRACE_QUERY_THRESHOLD", 10))
+
+
+@dataclass(slots=True)
+class RequestTrace:
+    start: float
+    # (service, operation) -> [calls, seconds]
+    calls: dict[tuple[str, str], list] = field(default_factory=dict)
+
+    def record(self, service: str, operation: str, seconds: float):
+        entry = self.calls.get((service, operation))
+        if entry is None:
+            self.calls[(service, operation)] = [1, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+    def count(self, service: str) -> int:
+        return sum(calls for (s, _), (calls, _) in self.calls.items() if s == service)
+
+    def server_timing(self) -> str:
+        """The trace as a Server-Timing header: the whole request, then every service and operation"""
+        entries = [f"total;dur={(time.perf_counter() - self.start) * 1000:.2f}"]
+        services: dict[str, list] = {}
+        for (service, operation), (calls, seconds) in self.calls.items():
+            totals = services.setdefault(service, [0, 0])
+            totals[0] += calls
+            totals[1] += seconds
+        for service, (calls, seconds) in services.items():
+            entries.append(f'{service};dur={seconds * 1000:.2f};desc="{calls} calls"')
+        for (service, operation), (calls, seconds) in self.calls.items():
+            entries.append(f'{service}.{operation};dur={seconds * 1000:.2f};desc="{calls} calls"')
+        return ", ".join(entries)
+
+
+# the trace of the request being handled. Tasks started by the handler share it.
+current_trace: ContextVar[RequestTrace | None] = ContextVar("current_trace", default=None)
+
+
+def record(service: str, operation: str, seconds: float):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.record(service, operation, seconds)
+
+
+def setup(app: Sanic):
+    """Traces the calls every request makes to other services"""
+
+    @app.on_request
+    async def start_trace(request: Request):
+        request.ctx.trace = RequestTrace(time.perf_counter())
+        current_trace.set(request.ctx.trace)
+
+    @app.on_response
+    async def finish_trace(request: Request, response: HTTPResponse):
+        trace: RequestTrace | None = getattr(request.ctx, "trace", None)
+        if trace is None:
+            return
+        queries = trace.count("prisma")
+        if TRACE_QUERY_THRESHOLD and queries > TRACE_QUERY_THRESHOLD:
+            logger.warning("%s %s made %d queries", request.method, request.path, queries, extra={
+                "method": request.method,
+                "path": request.path,
+                "status": response.status,
+                "queries": queries,
+                "calls": {f"{service}.{operation}": calls for (service, operation), (calls, _) in trace.calls.items()},
+            })
+        if TRACE_HEADER in request.headers:
+            response.headers["server-timing"] = trace.server_timing()
@@ -2,11 +2,27 @@ import os
 
 from dotenv import load_dotenv
 
-from concert_backend import app
-
+# the app reads its configuration while it is imported
 load_dotenv()
 
+from sanic.log import logger  # noqa: E402
+
+from concert_backend import app  # noqa: E402
+from concert_backend.util.kv import kv  # noqa: E402
+
+DEV = bool(int(os.getenv("DEV", 0)))
+# 0 starts one worker per CPU core. Workers only share OAuth states, codes and revoked refresh tokens through a
+# shared KV store, so without one a single worker is started
+WORKERS = int(os.getenv("WORKERS") or (0 if kv.shared and not DEV else 1)) or os.cpu_count() or 1
+
 if __name__ == "__main__":
-    app.run(host=os.getenv("HOST", "0.0.0.0"), port=int(os.getenv("PORT", 5000)), debug=True, auto_reload=True,
-            access_log=bool(int(os.getenv("DEV", 0))), motd=bool(int(os.getenv("DEV", 0))),
-            fast=not bool(int(os.getenv("DEV", 0))))
+    if WORKERS > 1 and not kv.shared:
+        logger.error("Running more than one worker needs KV_URL to point to a Redis server, so that OAuth states, "
+                     "codes and revoked refresh tokens are seen by every worker")
+        raise SystemExit(1)
+    # lets `sanic main:app --trigger-reload` restart the workers without stopping the server. Sanic restarts them
+    # all at once rather than one after the other, so this is not a rolling restart
+    app.config.INSPECTOR = bool(int(os.getenv("INSPECTOR", 0)))
+    app.config.GRACEFUL_SHUTDOWN_TIMEOUT = float(os.getenv("GRACEFUL_SHUTDOWN_TIMEOUT", 15))
+    app.run(host=os.getenv("HOST", "0.0.0.0"), port=int(os.getenv("PORT", 5000)), debug=DEV, auto_reload=DEV,
+            access_log=DEV, motd=DEV, workers=WORKERS)
@@ -197,6 +197,47 @@ export function leaveStage() {
 	currentStage.set(null);
 }
 
+function validateChatMessage(message: ChatMessage) {
+	// check that `message` correctly implements the ChatMessage interface
+	if (typeof message !== 'object' || !message) throw new Error('CHAT: Missing chat message');
+	if (typeof message.id !== 'string') throw new Error('CHAT: Missing message.id');
+	if (!['TEXT', 'FILE', 'EVENT'].includes(message.type))
+		throw new Error('CHAT: Invalid message.type');
+	if (typeof message.message_data !== 'string')
+		throw new Error('CHAT: Missing message.message_data');
+	if (typeof message.stage_id !== 'string') throw new Error('CHAT: Missing message.stage_id');
+	if (typeof message.user_id !== 'string') throw new Error('CHAT: Missing message.user_id');
+	if (typeof message.created_at !== 'string')
+		throw new Error('CHAT: Missing message.created_at');
+	if (typeof message.updated_at !== 'string')
+		throw new Error('CHAT: Missing message.updated_at');
+	if (typeof message.user !== 'object') throw new Error('CHAT: Missing message.user');
+	if (typeof message.user.username !== 'string')
+		throw new Error('CHAT: Missing message.user.username');
+	if (typeof message.user.avatar_url !== 'string')
+		throw new Error('CHAT: Missing message.user.avatar_url');
+}
+
+function changesSpeakers(message: ChatMessage) {
+	return ['made_speaker', 'made_listener'].includes(message.message_data.toLowerCase());
+}
+
+function refreshSpeakers() {
+	const r = get(stageRoom);
+	if (!r) return;
+	const newSpeakers: string[] = [];
+	if (r.localParticipant.permissions?.canPublish) {
+		newSpeakers.push(r.localParticipant.identity);
+	}
+	Array.from(r.participants.values()).forEach((p) => {
+		if (p.permissions?.canPublish) {
+			console.log(p.permissions, p.name);
+			newSpeakers.push(p.identity);
+		}
+	});
+	stageSpeakers.set([...new Set(newSpeakers)]);
+}
+
 function handleData(data: string, _p: RemoteParticipant | undefined) {
 	try {
 		const parsed = JSON.parse(data);
@@ -208,46 +249,20 @@ function handleData(data: string, _p: RemoteParticipant | undefined) {
 			case 'chat': {
 				if (!parsed.data) throw new Error('CHAT: Missing chat message');
 				const message = parsed.data as ChatMessage;
-				// check that `message` correctly implements the ChatMessage interface
-				if (typeof message.id !== 'string') throw new Error('CHAT: Missing message.id');
-				if (!['TEXT', 'FILE', 'EVENT'].includes(message.type))
-					throw new Error('CHAT: Invalid message.type');
-				if (typeof message.message_data !== 'string')
-					throw new Error('CHAT: Missing message.message_data');
-				if (typeof message.stage_id !== 'string') throw new Error('CHAT: Missing message.stage_id');
-				if (typeof message.user_id !== 'string') throw new Error('CHAT: Missing message.user_id');
-				if (typeof message.created_at !== 'string')
-					throw new Error('CHAT: Missing message.created_at');
-				if (typeof message.updated_at !== 'string')
-					throw new Error('CHAT: Missing message.updated_at');
-				if (typeof message.user !== 'object') throw new Error('CHAT: Missing message.user');
-				if (typeof message.user.username !== 'string')
-					throw new Error('CHAT: Missing message.user.username');
-				if (typeof message.user.avatar_url !== 'string')
-					throw new Error('CHAT: Missing message.user.avatar_url');
+				validateChatMessage(message);
 
 				chatMessages.update((messages) => [...messages, message]);
+				if (changesSpeakers(message)) refreshSpeakers();
+				break;
+			}
+			// several messages sent at once, e.g. when the owner changes the speakers of a stage in one go
+			case 'chat_batch': {
+				if (!Array.isArray(parsed.data)) throw new Error('CHAT_BATCH: Missing chat messages');
+				const batch = parsed.data as ChatMessage[];
+				batch.forEach(validateChatMessage);
 
-				switch (message.message_data.toLowerCase()) {
-					case 'made_speaker':
-					case 'made_listener': {
-						const r = get(stageRoom);
-						if (!r) break;
-						const newSpeakers: string[] = [];
-						if (r.localParticipant.permissions?.canPublish) {
-							newSpeakers.push(r.localParticipant.identity);
-						}
-						Array.from(r.participants.values()).forEach((p) => {
-							if (p.permissions?.canPublish) {
-								console.log(p.permissions, p.name);
-								newSpeakers.push(p.identity);
-							}
-						});
-						stageSpeakers.set([...new Set(newSpeakers)]);
-						break;
-					}
-				}
-
+				chatMessages.update((messages) => [...messages, ...batch]);
+				if (batch.some(changesSpeakers)) refreshSpeakers();
 				break;
 			}
 		}
@@ -5,14 +5,18 @@ import { addToasts } from './toasts';
 import token from './token';
 
 const stages = writable<Stage[]>([]);
+// cursor of the next page of stages, null once all stages were fetched
+export const nextStagesCursor = writable<string | null>(null);
 
-export async function fetchAllStages(limit = 20, offset = 0) {
-	const res = await fetch(`/api/stages/all?limit=${limit}&offset=${offset}`, {
+export async function fetchAllStages(limit = 20, cursor = get(nextStagesCursor)) {
+	const res = await fetch(`/api/stages/all?limit=${limit}${cursor ? `&cursor=${cursor}` : ''}`, {
 		headers: { Authorization: 'Bearer ' + get(token) }
 	});
 	const data = await res.json();
-	if (res.ok) stages.update((old) => [...new Set([...old, ...data.stages])]);
-	else addToasts([{ message: data.message, class: 'error', title: 'An error occured.' }]);
+	if (res.ok) {
+		stages.update((old) => [...new Set([...old, ...data.stages])]);
+		nextStagesCursor.set(data.next_cursor);
+	} else addToasts([{ message: data.message, class: 'error', title: 'An error occured.' }]);
 }
 
 export default stages;
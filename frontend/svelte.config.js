@@ -13,7 +13,8 @@ const config = {
 
 	kit: {
 		adapter: adapter({
-			fallback: 'index.html'
+			fallback: 'index.html',
+			precompress: true
 		})
 	}
 };